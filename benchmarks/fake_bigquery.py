@@ -0,0 +1,80 @@
+"""In-memory stand-in for the parts of ``bigquery.Client`` that BigqueryClient loads and inserts through."""
+import gzip
+import threading
+import time
+
+
+class FakeTableRef:
+
+    def __init__(self, dataset_id, table_id):
+        self.dataset_id = dataset_id
+        self.table_id = table_id
+        self.reference = self
+
+
+class FakeDatasetRef:
+
+    def __init__(self, dataset_id):
+        self.dataset_id = dataset_id
+
+    def table(self, table_id):
+        return FakeTableRef(self.dataset_id, table_id)
+
+
+class FakeJob:
+
+    def __init__(self, output_rows=0):
+        self.output_rows = output_rows
+        self.errors = None
+
+    def result(self):
+        return self
+
+
+class FakeBigqueryClient:
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.rows = dict()
+        self._lock = threading.Lock()
+
+    def dataset(self, dataset_id):
+        return FakeDatasetRef(dataset_id)
+
+    def get_table(self, table_ref):
+        self._wait()
+        return table_ref
+
+    def load_table_from_file(self, file_obj, table_ref, job_config=None, location=None):
+        self._wait()
+        content = file_obj.read()
+        if content[:2] == b'\x1f\x8b':
+            content = gzip.decompress(content)
+        output_rows = content.count(b'\n') + (1 if content and not content.endswith(b'\n') else 0)
+        self._add_rows(table_ref, output_rows, job_config is not None and job_config.write_disposition == 'WRITE_TRUNCATE')
+        return FakeJob(output_rows)
+
+    def insert_rows(self, table, rows):
+        self._wait()
+        self._add_rows(table, len(rows), False)
+        return []
+
+    def copy_table(self, source_ref, destination_ref, job_config=None):
+        self._wait()
+        source_rows = self.rows.get((source_ref.dataset_id, source_ref.table_id), 0)
+        self._add_rows(destination_ref, source_rows, job_config is None or job_config.write_disposition != 'WRITE_APPEND')
+        return FakeJob(source_rows)
+
+    def delete_table(self, table_ref, not_found_ok=False):
+        self._wait()
+        with self._lock:
+            self.rows.pop((table_ref.dataset_id, table_ref.table_id), None)
+
+    def _add_rows(self, table_ref, row_count, truncate):
+        key = (table_ref.dataset_id, table_ref.table_id)
+        with self._lock:
+            self.rows[key] = row_count if truncate else self.rows.get(key, 0) + row_count
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
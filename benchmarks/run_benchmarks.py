@@ -0,0 +1,173 @@
+"""Offline benchmarks for the clients in this package against local stand-in services.
+
+Run with ``python -m client_utils.benchmarks.run_benchmarks --scale 20000 --latency-ms 20``.
+Every scenario runs in a fresh process so the reported peak RSS belongs to that scenario alone.
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import time
+
+from requests.adapters import HTTPAdapter
+
+from .fake_bigquery import FakeBigqueryClient
+from .stub_servers import ForcetalkStubHandler, OktaStubHandler, PlatformStubHandler, SalesforceStubHandler, StubServer
+from ..bigquery_client import BigqueryClient
+from ..forcetalk_client import ForcetalkClient
+from ..platform_api_client import PlatformAPIClient
+from ..salesforce_client import SalesforceClient
+from ..salesforce_to_bigquery import export_query_to_bigquery
+
+SCENARIOS = ('query_all_fast', 'dml_records', 'save_json_to_bigquery', 'forcetalk_senders', 'get_platform_data', 'export_query_to_bigquery')
+
+
+class _PlainHttpAdapter(HTTPAdapter):
+    # simple_salesforce always builds https urls; the stub only speaks http
+    def send(self, request, **kwargs):
+        request.url = request.url.replace('https://', 'http://', 1)
+        return super().send(request, **kwargs)
+
+
+class _StubSalesforceClient(SalesforceClient):
+
+    def __init__(self, instance, **kwargs):
+        self.instance = instance
+        super().__init__(**kwargs)
+
+    def get_login_kwargs(self, env):
+        return dict(instance=self.instance, session_id='benchmark')
+
+    def new_session(self):
+        session = super().new_session()
+        session.mount('https://', _PlainHttpAdapter(pool_connections=10, pool_maxsize=10))
+        return session
+
+
+def _timed(function, latencies):
+    def wrapped_function(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    return wrapped_function
+
+
+def _assignment(index):
+    return {
+        'id': f'assignment-{index}',
+        'project': {'opportunityId': f'006{index:015d}'},
+        'staffingRequest': {'uuid': f'staffing-request-{index}'},
+        'consultant': {'employeeId': str(10000 + index)},
+        'duration': {'startsOn': '2020-01-01', 'endsOn': '2020-12-31'},
+        'effort': '100',
+        'shadow': 'false',
+    }
+
+
+def _run_query_all_fast(urls, scale, latencies):
+    client = _StubSalesforceClient(urls['salesforce'].split('://')[1])
+    client.query_more_with_timeout = _timed(client.query_more_with_timeout, latencies)
+    return len(client.query_all_fast('select Id from pse__Assignment__c'))
+
+
+def _run_dml_records(urls, scale, latencies):
+    client = _StubSalesforceClient(urls['salesforce'].split('://')[1], bulk_threshold=scale + 1)
+    client._dml_collection_request = _timed(client._dml_collection_request, latencies)
+    records = [{'pse__Project__c': f'a0P{index:015d}', 'pse__Percent_Allocated__c': 100} for index in range(scale)]
+    return len(client.dml_records('pse__Assignment__c', 'insert', records))
+
+
+def _run_save_json_to_bigquery(urls, scale, latencies):
+    client = BigqueryClient()
+    client._client = FakeBigqueryClient(latency=urls['latency'])
+    client._load_ndjson = _timed(client._load_ndjson, latencies)
+    records = (SalesforceStubHandler._record(index) for index in range(scale))
+    client.save_json_to_bigquery('benchmark', 'assignments', [], records, overwrite=True, chunk_size=max(1, scale // 8))
+    return scale
+
+
+def _run_forcetalk_senders(urls, scale, latencies):
+    client = ForcetalkClient()
+    client.forcetalk_host = urls['forcetalk']
+    client.send_assignment_to_forcetalk = _timed(client.send_assignment_to_forcetalk, latencies)
+    results = client.send_assignments((_assignment(index) for index in range(scale)), concurrency=10)
+    return sum(result['success'] for result in results)
+
+
+def _run_get_platform_data(urls, scale, latencies):
+    client = PlatformAPIClient()
+    client.platform_host = urls['platform']
+    client.okta_host = urls['okta']
+    client.get_platform_data = _timed(client.get_platform_data, latencies)
+    return len(client.get_assignment_by_ass_id([f'assignment-{index}' for index in range(scale)]))
+
+
+def _run_export_query_to_bigquery(urls, scale, latencies):
+    from google.cloud import bigquery
+    salesforce_client = _StubSalesforceClient(urls['salesforce'].split('://')[1])
+    salesforce_client.query_more_with_timeout = _timed(salesforce_client.query_more_with_timeout, latencies)
+    bigquery_client = BigqueryClient()
+    bigquery_client._client = FakeBigqueryClient(latency=urls['latency'])
+    schema = [bigquery.SchemaField('Id', 'STRING'), bigquery.SchemaField('Resource_Request__r_Jigsaw_ID__c', 'STRING'),
+              bigquery.SchemaField('pse__Percent_Allocated__c', 'FLOAT'), bigquery.SchemaField('Shadow__c', 'BOOLEAN')]
+    return export_query_to_bigquery(salesforce_client, bigquery_client, 'select Id from pse__Assignment__c', 'benchmark', 'assignments',
+                                    schema, chunk_size=max(1, scale // 8))
+
+
+def run_scenario(name, urls, scale):
+    latencies = []
+    start = time.perf_counter()
+    items = globals()[f'_run_{name}'](urls, scale, latencies)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'scenario': name,
+        'items': items,
+        'seconds': elapsed,
+        'items_per_second': items / elapsed if elapsed else 0.0,
+        'calls': len(latencies),
+        'p50_ms': _percentile(latencies, 50) * 1000,
+        'p99_ms': _percentile(latencies, 99) * 1000,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def _percentile(sorted_values, percentile):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percentile / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=int, default=10000, help='records / entities per scenario')
+    parser.add_argument('--latency-ms', type=float, default=0, help='latency added to every stub response')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    latency = args.latency_ms / 1000
+    with StubServer(SalesforceStubHandler, latency, total_records=args.scale) as salesforce, \
+            StubServer(OktaStubHandler, latency) as okta, \
+            StubServer(ForcetalkStubHandler, latency) as forcetalk, \
+            StubServer(PlatformStubHandler, latency) as platform:
+        urls = dict(salesforce=salesforce.url, okta=okta.url, forcetalk=forcetalk.url, platform=platform.url, latency=latency)
+        context = multiprocessing.get_context('spawn')
+        results = []
+        for name in args.scenarios:
+            with context.Pool(1) as pool:
+                results.append(pool.apply(run_scenario, (name, urls, args.scale)))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'scenario':<24}{'items':>9}{'seconds':>10}{'items/s':>12}{'calls':>8}{'p50 ms':>10}{'p99 ms':>10}{'peak RSS MB':>13}")
+    for result in results:
+        print(f"{result['scenario']:<24}{result['items']:>9}{result['seconds']:>10.2f}{result['items_per_second']:>12.1f}"
+              f"{result['calls']:>8}{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}{result['peak_rss_mb']:>13.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Local stand-ins for Salesforce, Okta, Forcetalk and the Platform API."""
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+SALESFORCE_API_PATH = '/services/data/v42.0'
+SALESFORCE_PAGE_SIZE = 2000
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_PATCH(self):
+        self._dispatch('PATCH')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def _dispatch(self, method):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urlsplit(self.path)
+        status, payload = self.handle_request(method, url.path, parse_qs(url.query), body)
+        content = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def handle_request(self, method, path, query, body):
+        return 200, {}
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SalesforceStubHandler(StubHandler):
+    """Serves paged SOQL results of ``server.total_records`` rows and sObject Collections DML."""
+
+    def handle_request(self, method, path, query, body):
+        if method == 'GET' and path.startswith(f'{SALESFORCE_API_PATH}/query/'):
+            offset = int(path.rsplit('-', 1)[1]) if '-' in path else 0
+            return 200, self._query_page(offset)
+        if path == f'{SALESFORCE_API_PATH}/composite/sobjects':
+            if method == 'DELETE':
+                ids = query['ids'][0].split(',')
+            else:
+                ids = [record.get('Id', f'a0X{index:015d}') for index, record in enumerate(json.loads(body)['records'])]
+            return 200, [{'id': id, 'success': True, 'errors': []} for id in ids]
+        return 404, [{'errorCode': 'NOT_FOUND', 'message': path}]
+
+    def _query_page(self, offset):
+        total = self.server.total_records
+        end = min(offset + SALESFORCE_PAGE_SIZE, total)
+        page = OrderedDict(totalSize=total, done=end >= total, records=[self._record(index) for index in range(offset, end)])
+        if not page['done']:
+            page['nextRecordsUrl'] = f'{SALESFORCE_API_PATH}/query/01gBENCH00000001-{end}'
+        return page
+
+    @staticmethod
+    def _record(index):
+        return OrderedDict([
+            ('attributes', {'type': 'pse__Assignment__c', 'url': f'{SALESFORCE_API_PATH}/sobjects/pse__Assignment__c/a0X{index:015d}'}),
+            ('Id', f'a0X{index:015d}'),
+            ('Jigsaw_Assignment_ID__c', f'jigsaw-{index}'),
+            ('pse__Start_Date__c', '2020-01-01'),
+            ('pse__End_Date__c', '2020-12-31'),
+            ('Resource_Request__r', {'attributes': {'type': 'pse__Resource_Request__c'}, 'Jigsaw_ID__c': f'rr-{index}'}),
+            ('pse__Percent_Allocated__c', 100.0),
+            ('Shadow__c', index % 7 == 0),
+            ('pse__Bill_Rate__c', 1234.5),
+        ])
+
+
+class OktaStubHandler(StubHandler):
+
+    def handle_request(self, method, path, query, body):
+        return 200, {'token_type': 'Bearer', 'expires_in': 3600, 'access_token': 'benchmark-token', 'scope': 'api'}
+
+
+class ForcetalkStubHandler(StubHandler):
+    pass
+
+
+class PlatformStubHandler(StubHandler):
+
+    def handle_request(self, method, path, query, body):
+        if path.endswith('/jigsaw/assignments'):
+            ids = query.get('ids[]', []) or query.get('opportunity_ids[]', [])
+            return 200, [{'id': id, 'duration': {'startsOn': '01-01-2020', 'endsOn': '31-12-2020'}, 'effort': '100'} for id in ids]
+        return 200, {'content': []}
+
+
+class StubServer:
+
+    def __init__(self, handler_class, latency=0, **attributes):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+        self.server.daemon_threads = True
+        self.server.latency = latency
+        for name, value in attributes.items():
+            setattr(self.server, name, value)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,52 @@
+"""Requests/sec of a fresh session per call versus the shared pooled transport.
+
+Run with ``python -m client_utils.benchmarks.transport_benchmark``.
+"""
+import argparse
+import time
+
+import requests
+
+from .stub_servers import ForcetalkStubHandler, StubServer
+from ..request_client import NewRequest, Transport
+
+
+def _fresh_session_get(url):
+    session = requests.sessions.Session()
+    try:
+        res = session.get(url, timeout=30)
+        res.close()
+    finally:
+        session.close()
+
+
+def _pooled_get(url):
+    with NewRequest.get(url) as request:
+        request.response.content
+
+
+def _measure(func, url, total):
+    start = time.perf_counter()
+    for _ in range(total):
+        func(url)
+    return total / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    with StubServer(ForcetalkStubHandler) as server:
+        try:
+            before = _measure(_fresh_session_get, server.url, args.requests)
+            after = _measure(_pooled_get, server.url, args.requests)
+        finally:
+            Transport.close()
+    print(f'fresh session per call: {before:10.1f} req/s')
+    print(f'shared pooled transport: {after:10.1f} req/s')
+    print(f'speedup: {after / before:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
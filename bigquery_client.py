@@ -1,27 +1,248 @@
+from collections import OrderedDict
+import glob
+import gzip
 import io
+import itertools
 import json
 import os
+import queue
+import threading
+import time
+import uuid
 
 from google.cloud import bigquery
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from python_utils.logger import Logger
 from python_utils.thread_pool import ThreadPool
 from .config import Config
+from .metrics import instrumented
+from .retry_policy import RetryPolicy
+
+
+def _prefetch(iterable, depth=1):
+    # iterate `iterable` in a background thread, keeping at most `depth` items ready ahead of the consumer
+    items = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stopped.is_set():
+                    try:
+                        items.put((item, None), timeout=1)
+                        break
+                    except queue.Full:
+                        pass
+                if stopped.is_set():
+                    return
+            items.put((done, None))
+        except Exception as e:
+            items.put((done, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
+class BigqueryWriter:
+
+    def __init__(self, client, table, max_rows=500, max_bytes=5 * 1024 * 1024, flush_interval=5, max_buffered_rows=10000, retries=3):
+        self.client = client
+        self.table = table
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.max_buffered_rows = max_buffered_rows
+        self.retry_policy = RetryPolicy(retries=retries + 1, base_delay=1, retry_on_exception=lambda e: isinstance(e, Exception), retry_on_result=bool)
+        self.failed_rows = []
+        self._rows = []
+        self._row_sizes = []
+        self._bytes = 0
+        self._in_flight = False
+        self._flush_requested = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, rows):
+        for row in rows:
+            row_bytes = len(json.dumps(row, default=str))
+            with self._condition:
+                while len(self._rows) >= self.max_buffered_rows and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    raise RuntimeError(f"op=BigqueryWriter.write | status=Fail | desc=writer for {self.table.table_id} is closed")
+                self._rows.append(row)
+                self._row_sizes.append(row_bytes)
+                self._bytes += row_bytes
+                if self._is_full():
+                    self._condition.notify_all()
+
+    def flush(self):
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+            while self._rows or self._in_flight:
+                self._condition.wait()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        if self.failed_rows:
+            raise RuntimeError(f"op=BigqueryWriter.close | status=Fail | desc=table_id: {self.table.table_id}, {len(self.failed_rows)} rows failed to insert")
+
+    def _is_full(self):
+        return len(self._rows) >= self.max_rows or self._bytes >= self.max_bytes
+
+    def _run(self):
+        while True:
+            with self._condition:
+                deadline = time.monotonic() + self.flush_interval
+                while not (self._closed or self._flush_requested or self._is_full()):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                rows, row_sizes = self._rows, self._row_sizes
+                self._rows, self._row_sizes, self._bytes = [], [], 0
+                self._in_flight = bool(rows)
+                self._flush_requested = False
+                closed = self._closed
+                self._condition.notify_all()
+            if rows:
+                for batch in self._batches(rows, row_sizes):
+                    self._insert_rows(batch)
+                with self._condition:
+                    self._in_flight = False
+                    self._condition.notify_all()
+            elif closed:
+                return
+
+    def _batches(self, rows, row_sizes):
+        # every insert_rows request stays within max_rows and max_bytes, however much was buffered
+        start, batch_bytes = 0, 0
+        for index, row_bytes in enumerate(row_sizes):
+            if index > start and (index - start >= self.max_rows or batch_bytes + row_bytes > self.max_bytes):
+                yield rows[start:index]
+                start, batch_bytes = index, 0
+            batch_bytes += row_bytes
+        if start < len(rows):
+            yield rows[start:]
+
+    @instrumented('bigquery', 'writer_insert_rows')
+    def _insert_rows(self, rows):
+        # each retry re-sends only the rows the previous insert rejected
+        pending = rows
+
+        def insert_pending():
+            nonlocal pending
+            errors = self.client.insert_rows(self.table, pending)
+            if errors:
+                Logger.error(f"op=BigqueryWriter.insert_rows | status=Fail | desc=table_id: {self.table.table_id}, {len(errors)} rows failed, first errors: {str(errors[:3])}")
+            pending = [pending[error['index']] for error in errors]
+            return pending
+
+        try:
+            self.retry_policy.call(insert_pending)
+        except Exception as e:
+            Logger.error(f"op=BigqueryWriter.insert_rows | status=Fail | desc=table_id: {self.table.table_id}, {len(pending)} rows: {e}")
+        if pending:
+            self.failed_rows.extend(pending)
+        else:
+            Logger.debug(f"op=BigqueryWriter.insert_rows | status=OK | desc=table_id: {self.table.table_id}, rows: {len(rows)}")
 
 
 class BigqueryClient:
 
     def __init__(self, env='uat'):
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = f'client_utils/{Config.get_config(env, "GOOGLE_APPLICATION_CREDENTIALS")}'
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._tables = dict()
+        self._tables_lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = bigquery.Client()
+        return self._client
+
+    def get_table(self, client, dataset_id, table_id):
+        key = (dataset_id, table_id)
+        if key not in self._tables:
+            table = client.get_table(client.dataset(dataset_id).table(table_id))
+            with self._tables_lock:
+                self._tables.setdefault(key, table)
+        return self._tables[key]
+
+    def get_writer(self, dataset_id, table_id, **kwargs):
+        client = self.client
+        return BigqueryWriter(client, self.get_table(client, dataset_id, table_id), **kwargs)
 
     def load_csv_file_into_bigquery(self, dataset_id, table_id, csv_file_name, schema):
-        client = bigquery.Client()
+        output_rows = self._load_csv_file(dataset_id, table_id, csv_file_name, schema, 'WRITE_TRUNCATE')
+        Logger.info(
+            f"op=load-csv-file-into-bigquery | status=OK | desc=Loaded {output_rows} rows into {dataset_id}:{table_id}")
+
+    def load_csv_files_into_bigquery(self, dataset_id, table_id, csv_file_names, schema, overwrite=True, max_concurrent_jobs=8):
+        # csv_file_names is a list of files or a glob pattern; returns {file name: rows loaded}
+        if isinstance(csv_file_names, str):
+            csv_file_names = sorted(glob.glob(csv_file_names))
+        if not csv_file_names:
+            raise RuntimeError(f"op=load_csv_files_into_bigquery | status=Fail| desc=dataset_id: {dataset_id}, table_id: {table_id}, no csv files")
+        write_disposition = 'WRITE_TRUNCATE' if overwrite else 'WRITE_APPEND'
+        if len(csv_file_names) == 1:
+            load_table_id, load_write_disposition = table_id, write_disposition
+        else:
+            # shards land in a temp table first so that the target only changes, in one copy, once every shard loaded
+            load_table_id, load_write_disposition = f'{table_id}_tmp_{uuid.uuid4().hex}', 'WRITE_APPEND'
+        try:
+            thread_pool = ThreadPool(total_thread_number=max_concurrent_jobs)
+            for csv_file_name in csv_file_names:
+                thread_pool.apply_async(self._load_csv_file, (dataset_id, load_table_id, csv_file_name, schema, load_write_disposition))
+            rows_per_file = OrderedDict(zip(csv_file_names, thread_pool.get_results_order_by_index(raise_exception=True)))
+            if load_table_id != table_id:
+                self._copy_table(self.client, dataset_id, load_table_id, table_id, write_disposition)
+        finally:
+            if load_table_id != table_id:
+                self.client.delete_table(self.client.dataset(dataset_id).table(load_table_id), not_found_ok=True)
+        Logger.info(
+            f"op=load-csv-files-into-bigquery | status=OK | desc=Loaded {sum(rows_per_file.values())} rows from {len(csv_file_names)} files into {dataset_id}:{table_id}")
+        return rows_per_file
+
+    @instrumented('bigquery', 'load_csv')
+    def _load_csv_file(self, dataset_id, table_id, csv_file_name, schema, write_disposition):
+        client = self.client
         dataset_ref = client.dataset(dataset_id)
         table_ref = dataset_ref.table(table_id)
         job_config = bigquery.LoadJobConfig()
         job_config.source_format = bigquery.SourceFormat.CSV
         job_config.skip_leading_rows = 0
-        job_config.write_disposition = 'WRITE_TRUNCATE'
+        job_config.write_disposition = write_disposition
         job_config.autodetect = True
         job_config.allowQuotedNewlines = True
         job_config.quote = '"'
@@ -37,43 +258,127 @@ class BigqueryClient:
         try:
             job.result()
         except:
-            raise RuntimeError(f"op=load_csv_file_into_bigquery | status=Fail| desc=dataset_id: {dataset_id}, table_id: {table_id}, errors: {str(job.errors)}")
-        Logger.info(
-            f"op=load-csv-file-into-bigquery | status=OK | desc=Loaded {job.output_rows} rows into {dataset_id}:{table_id}")
+            raise RuntimeError(f"op=load_csv_file_into_bigquery | status=Fail| desc=dataset_id: {dataset_id}, table_id: {table_id}, csv_file_name: {csv_file_name}, errors: {str(job.errors)}")
+        return job.output_rows
 
-    def save_json_to_bigquery(self, dataset_id, table_id, schema, data, overwrite=False):
+    def save_json_to_bigquery(self, dataset_id, table_id, schema, data, overwrite=False, chunk_size=50000, compress=False, max_concurrent_jobs=4):
         Logger.info("\nStart write to bigquery\n")
-        content = io.StringIO('\n'.join(json.dumps(record) for record in data))
-        client = bigquery.Client()
-        dataset_ref = client.dataset(dataset_id)
-        table_ref = dataset_ref.table(table_id)
+        client = self.client
+        write_disposition = 'WRITE_TRUNCATE' if overwrite else 'WRITE_APPEND'
+        chunks = self._iter_ndjson_chunks(data, chunk_size, compress)
+        first_chunk, second_chunk = next(chunks, None), next(chunks, None)
+        if second_chunk is None:
+            self._load_ndjson(client, dataset_id, table_id, schema, first_chunk or io.BytesIO(), compress, write_disposition)
+        else:
+            # chunks land in a temp table first so that the target only changes, in one copy, once every chunk loaded
+            load_table_id = f'{table_id}_tmp_{uuid.uuid4().hex}'
+            try:
+                self._load_ndjson_chunks(client, dataset_id, load_table_id, schema, itertools.chain((first_chunk, second_chunk), chunks), compress, max_concurrent_jobs)
+                self._copy_table(client, dataset_id, load_table_id, table_id, write_disposition)
+            finally:
+                client.delete_table(client.dataset(dataset_id).table(load_table_id), not_found_ok=True)
+        Logger.info("\nFinish write to bigquery\n")
+
+    def _load_ndjson_chunks(self, client, dataset_id, table_id, schema, chunks, compress, max_concurrent_jobs):
+        thread_pool = ThreadPool(total_thread_number=max_concurrent_jobs)
+        slots = threading.BoundedSemaphore(max_concurrent_jobs)
+        failed = threading.Event()
+        for chunk in chunks:
+            slots.acquire()
+            if failed.is_set():
+                slots.release()
+                break
+            thread_pool.apply_async(self._load_ndjson_chunk, (slots, failed, client, dataset_id, table_id, schema, chunk, compress))
+        thread_pool.wait_all_threads(raise_exception=True)
+
+    def _load_ndjson_chunk(self, slots, failed, client, dataset_id, table_id, schema, chunk, compress):
+        try:
+            self._load_ndjson(client, dataset_id, table_id, schema, chunk, compress, 'WRITE_APPEND')
+        except Exception:
+            failed.set()
+            raise
+        finally:
+            slots.release()
+
+    @instrumented('bigquery', 'load_ndjson')
+    def _load_ndjson(self, client, dataset_id, table_id, schema, content, compress, write_disposition):
+        table_ref = client.dataset(dataset_id).table(table_id)
         job_config = bigquery.LoadJobConfig()
         job_config.source_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
-        if overwrite:
-            job_config.write_disposition = 'WRITE_TRUNCATE'
-        else:
-            job_config.write_disposition = 'WRITE_APPEND'
+        job_config.write_disposition = write_disposition
         job_config.autodetect = True
         job_config.schema = schema
-        client.load_table_from_file(content, table_ref, job_config=job_config).result()
-        Logger.info("\nFinish write to bigquery\n")
+        job = client.load_table_from_file(content, table_ref, job_config=job_config)
+        job.result()
+        Logger.debug(f"op=load-ndjson | status=OK | desc=Loaded {job.output_rows} rows into {dataset_id}:{table_id}, compressed={compress}")
+
+    def _copy_table(self, client, dataset_id, source_table_id, table_id, write_disposition):
+        job_config = bigquery.CopyJobConfig()
+        job_config.write_disposition = write_disposition
+        dataset_ref = client.dataset(dataset_id)
+        client.copy_table(dataset_ref.table(source_table_id), dataset_ref.table(table_id), job_config=job_config).result()
 
+    @staticmethod
+    def _iter_ndjson_chunks(data, chunk_size, compress):
+        data = iter(data)
+        while True:
+            content = io.BytesIO()
+            stream = gzip.GzipFile(fileobj=content, mode='wb') if compress else content
+            row_count = 0
+            for record in itertools.islice(data, chunk_size):
+                stream.write(json.dumps(record).encode('utf-8') + b'\n')
+                row_count += 1
+            if row_count == 0:
+                return
+            if compress:
+                stream.close()
+            content.seek(0)
+            yield content
+
+    @instrumented('bigquery', 'query_rows')
     def query_rows_from_bigquery(self, query_string):
-        client = bigquery.Client()
+        client = self.client
         return list(client.query(query_string).result())
 
+    def iter_query_rows_from_bigquery(self, query_string, page_size=None, prefetch=1):
+        for page in _prefetch(self._query_pages(query_string, page_size), prefetch):
+            yield from page
+
+    def iter_query_columns_from_bigquery(self, query_string, batch_size=10000, page_size=None, prefetch=1):
+        # yields {column name: column values} per batch, as numpy arrays when numpy is installed
+        rows = self.iter_query_rows_from_bigquery(query_string, page_size=page_size, prefetch=prefetch)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return
+            field_names = list(batch[0].keys())
+            columns = zip(*(row.values() for row in batch))
+            if numpy is not None:
+                yield {field_name: numpy.array(column) for field_name, column in zip(field_names, columns)}
+            else:
+                yield {field_name: list(column) for field_name, column in zip(field_names, columns)}
+
+    def _query_pages(self, query_string, page_size):
+        client = self.client
+        job = client.query(query_string)
+        rows = job.result()
+        if page_size is not None and job.destination is not None:
+            rows = client.list_rows(bigquery.Table(job.destination, schema=rows.schema), page_size=page_size)
+        for page in rows.pages:
+            yield list(page)
+
+    @instrumented('bigquery', 'write_rows')
     def write_rows_to_bigquery(self, dataset_id, table_id, rows_to_insert):
-        client = bigquery.Client()
-        table_ref = client.dataset(dataset_id).table(table_id)
-        table = client.get_table(table_ref)
+        client = self.client
+        table = self.get_table(client, dataset_id, table_id)
         errors = client.insert_rows(table, rows_to_insert)
         if errors:
             raise RuntimeError(f"op=write_rows_to_bigquery | status=OK| desc=dataset_id: {dataset_id}, table_id: {table_id}, rows_to_insert: {str(rows_to_insert)}, errors: {str(errors)}")
         else:
-            Logger.debug(f"op=write_rows_to_bigquery | status=OK | desc=dataset_id: {dataset_id}, table_id: {table_id}, rows_to_insert: {str(rows_to_insert)}")
+            Logger.debug(f"op=write_rows_to_bigquery | status=OK | desc=dataset_id: {dataset_id}, table_id: {table_id}, rows_inserted: {len(rows_to_insert)}")
 
     def create_dataset(self, dataset_id):
-        client = bigquery.Client()
+        client = self.client
         client.create_dataset(dataset_id, exists_ok=True)
 
     def create_connection(self, client, dataset_id, table_id):
@@ -82,31 +387,92 @@ class BigqueryClient:
         return dataset.table(table_id)
 
     def create_table(self, dataset_id, table_id, schema):
-        client = bigquery.Client()
+        client = self.client
         table_ref = self.create_connection(client, dataset_id, table_id)
         table = bigquery.Table(table_ref, schema)
         client.create_table(table)
 
-    def delete_tables_in_datasets(self, dataset_ids):
-        thread_pool = ThreadPool(total_thread_number=30)
-        client = bigquery.Client()
-        thread_results = []
-        for dataset_id in dataset_ids:
-            tables = list(client.list_tables(dataset_id))
-            for table in tables:
-                thread_results.append(thread_pool.apply_async(self.delete_table, (dataset_id, table.table_id,)))
-        thread_pool.wait_all_threads(raise_exception=True)
+    def run_on_tables(self, dataset_ids, operation, concurrency=30, list_concurrency=10, rate_limiter=None):
+        # datasets are listed concurrently and table handles stream straight into `concurrency` workers
+        handles = queue.Queue(maxsize=concurrency * 2)
+        done = object()
+        results = []
+        errors = []
+
+        def list_dataset(dataset_id):
+            for table in self.client.list_tables(dataset_id):
+                handles.put(table)
 
+        def work():
+            while True:
+                table = handles.get()
+                if table is done:
+                    return
+                if rate_limiter is not None:
+                    rate_limiter.acquire()
+                try:
+                    results.append(operation(table))
+                except Exception as e:
+                    Logger.error(f"op=run_on_tables | status=Fail | desc=table: {table.dataset_id}.{table.table_id}, error: {e}")
+                    errors.append((table, e))
+
+        worker_pool = ThreadPool(total_thread_number=concurrency)
+        for _ in range(concurrency):
+            worker_pool.apply_async(work)
+        list_pool = ThreadPool(total_thread_number=list_concurrency)
+        try:
+            for dataset_id in dataset_ids:
+                list_pool.apply_async(list_dataset, (dataset_id,))
+            list_pool.wait_all_threads(raise_exception=True)
+        finally:
+            for _ in range(concurrency):
+                handles.put(done)
+            worker_pool.wait_all_threads(raise_exception=True)
+        if errors:
+            raise RuntimeError(f"op=run_on_tables | status=Fail | desc={len(errors)} tables failed, first error: {str(errors[0][1])}")
+        return results
+
+    def delete_tables_in_datasets(self, dataset_ids, concurrency=30, rate_limiter=None):
+        self.run_on_tables(dataset_ids, lambda table: self.client.delete_table(table.reference, not_found_ok=True),
+                           concurrency=concurrency, rate_limiter=rate_limiter)
+
+    @instrumented('bigquery', 'delete_table')
     def delete_table(self, dataset_id, table_id):
-        client = bigquery.Client()
+        client = self.client
         table_ref = self.create_connection(client, dataset_id, table_id)
         table = bigquery.Table(table_ref)
         client.delete_table(table, not_found_ok=True)
 
-    def read_view_of_dataset(self, dataset_id):
-        bq_client = bigquery.Client()
-        tables = list(bq_client.list_tables(dataset_id))
-        for table in tables:
-            view = bq_client.get_table(table)
-            with open(f'{view.table_id}.sql', 'w') as f:
+    def read_view_of_dataset(self, dataset_id, output_dir='.', incremental=False, concurrency=10, rate_limiter=None):
+        # incremental runs take every view's last_modified_time from one __TABLES__ query and only get_table views
+        # that moved since the manifest of the last export or whose .sql file is gone
+        manifest_path = os.path.join(output_dir, f'.{dataset_id}_views.json')
+        manifest = dict()
+        modified_times = dict()
+        if incremental:
+            if os.path.exists(manifest_path):
+                with open(manifest_path) as f:
+                    manifest = json.load(f)
+            modified_times = {row['table_id']: row['last_modified_time'] for row in
+                              self.client.query(f"select table_id, last_modified_time from `{dataset_id}.__TABLES__` where type = 2").result()}
+
+        def export_view(table):
+            if table.table_type != 'VIEW':
+                return None
+            modified = modified_times.get(table.table_id)
+            file_name = os.path.join(output_dir, f'{table.table_id}.sql')
+            if modified is not None and manifest.get(table.table_id) == modified and os.path.exists(file_name):
+                return table.table_id, modified, False
+            view = self.client.get_table(table.reference)
+            with open(file_name, 'w') as f:
                 f.write(view.view_query)
+            if view.modified is not None:
+                # same epoch milliseconds as __TABLES__, so a full export leaves a usable manifest behind
+                modified = int(view.modified.timestamp() * 1000)
+            return table.table_id, modified, True
+
+        exported = [result for result in self.run_on_tables([dataset_id], export_view, concurrency=concurrency, list_concurrency=1,
+                                                            rate_limiter=rate_limiter) if result is not None]
+        with open(manifest_path, 'w') as f:
+            json.dump({table_id: modified for table_id, modified, _ in exported}, f, indent=2, sort_keys=True)
+        Logger.info(f"op=read_view_of_dataset | status=OK | desc=dataset_id: {dataset_id}, views: {len(exported)}, exported: {sum(written for _, _, written in exported)}")
@@ -0,0 +1,12 @@
+def chunk_by_length(items, max_length, separator_length=0):
+    # groups strings so that each chunk, with `separator_length` extra characters per item, fits in max_length
+    chunk, length = [], 0
+    for item in items:
+        item_length = len(item) + separator_length
+        if chunk and length + item_length > max_length:
+            yield chunk
+            chunk, length = [], 0
+        chunk.append(item)
+        length += item_length
+    if chunk:
+        yield chunk
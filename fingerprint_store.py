@@ -0,0 +1,42 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class FingerprintStore:
+    """SQLite-backed map of entity id -> hash of the last payload sent for it."""
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ':memory:':
+            self._connection.execute('pragma journal_mode=WAL')
+        self._connection.execute('create table if not exists fingerprints (entity_id text primary key, digest text not null, updated_at real not null)')
+
+    @staticmethod
+    def fingerprint(payload):
+        return hashlib.sha1(json.dumps(payload, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+    def is_unchanged(self, entity_id, digest):
+        with self._lock:
+            row = self._connection.execute('select digest from fingerprints where entity_id = ?', (entity_id,)).fetchone()
+        return row is not None and row[0] == digest
+
+    def put(self, entity_id, digest):
+        with self._lock:
+            self._connection.execute('insert or replace into fingerprints (entity_id, digest, updated_at) values (?, ?, ?)',
+                                     (entity_id, digest, time.time()))
+
+    def invalidate(self, entity_ids=None):
+        with self._lock:
+            if entity_ids is None:
+                self._connection.execute('delete from fingerprints')
+            else:
+                self._connection.executemany('delete from fingerprints where entity_id = ?', ((entity_id,) for entity_id in entity_ids))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
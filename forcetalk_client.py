@@ -1,40 +1,57 @@
 import json
 from gevent import sleep
 from python_utils.logger import Logger
-from request_client import NewRequest
+from python_utils.thread_pool import ThreadPool
+from .request_client import NewRequest
 from .config import Config
+from .fingerprint_store import FingerprintStore
+from .metrics import instrumented
+from .retry_policy import RetryBudget, RetryPolicy
+
+
+retry_budget = RetryBudget()
+
+
+def _send(func, args, kwargs):
+    with func(*args, **kwargs) as request:
+        return request.response
 
 
 def request_with_retry(func, args=None, kwargs=None, retries=3, retry_interval=5):
-    res = None
-    for _ in range(retries):
-        if args is None:
-            args = tuple()
-        if kwargs is None:
-            kwargs = dict()
-        res = func(*args, **kwargs)
-        if res.status_code != 200:
-            sleep(retry_interval)
-        else:
-            break
-    else:
+    if args is None:
+        args = tuple()
+    if kwargs is None:
+        kwargs = dict()
+    policy = RetryPolicy(retries=retries, base_delay=retry_interval, budget=retry_budget, sleep=sleep)
+    res = policy.call(_send, (func, args, kwargs), host=kwargs.get('url'))
+    if not 200 <= res.status_code < 300:
         raise RuntimeError(f"failed to execute {func.__name__} with args={str(args)}, kwargs={str(kwargs)}: {res.status_code} | {res.text}")
+    return res
 
 
 class ForcetalkClient:
 
-    def __init__(self, env='uat'):
+    def __init__(self, env='uat', fingerprint_store=None):
         self.forcetalk_host = Config.get_config(env, "forcetalk_host")
+        self.fingerprint_store = fingerprint_store
 
+    @instrumented('forcetalk', 'delete_resource_request')
     def delete_resource_request(self, res_req_id):
         forcetalk_url = f'{self.forcetalk_host}/forcetalk/ResourceRequest/{res_req_id}'
         headers = {"Accept": "application/json", "Content-type": "application/json"}
         Logger.debug(f"delete_resource_request with {res_req_id}")
         request_with_retry(NewRequest.delete, kwargs=dict(url=forcetalk_url, headers=headers, timeout=30))
+        self.invalidate_fingerprints([res_req_id])
 
-    def send_staffing_request_to_forcetalk(self, staffing_request):
+    @instrumented('forcetalk', 'send_staffing_request')
+    def send_staffing_request_to_forcetalk(self, staffing_request, force=False):
         Logger.debug(f"send_staffing_request_to_forcetalk with {staffing_request}")
-        data = {
+        data = self.build_staffing_request_payload(staffing_request)
+        forcetalk_url = f'{self.forcetalk_host}/forcetalk/ResourceRequest?checkEligible=false'
+        return self._post_if_changed(forcetalk_url, data, force)
+
+    def build_staffing_request_payload(self, staffing_request):
+        return {
             "id": staffing_request['id'],
             "project": {
                 'sf_id': staffing_request['opportunityId']
@@ -47,9 +64,6 @@ class ForcetalkClient:
             "role": staffing_request['roleName'],
             "workingOffices": self.generate_working_offices(staffing_request['workingOffices'])
         }
-        forcetalk_url = f'{self.forcetalk_host}/forcetalk/ResourceRequest?checkEligible=false'
-        headers = {"Accept": "application/json", "Content-type": "application/json"}
-        request_with_retry(NewRequest.post, kwargs=dict(url=forcetalk_url, headers=headers, data=json.dumps(data), timeout=30))
 
     def generate_working_offices(self, working_offices):
         return [{
@@ -59,21 +73,48 @@ class ForcetalkClient:
             'rate': float(office['rate']),
         } for office in working_offices]
 
+    @instrumented('forcetalk', 'flag_as_daily_rate_project')
     def flag_as_daily_rate_project(self, opportunity_id):
         Logger.debug(f"flag_as_daily_rate_project with {opportunity_id}")
         forcetalk_url = f'{self.forcetalk_host}/forcetalk/Project/flagAsDailyRateProject/{opportunity_id}'
         headers = {"Accept": "application/json", "Content-type": "application/json"}
         request_with_retry(NewRequest.put, kwargs=dict(url=forcetalk_url, headers=headers, timeout=30))
 
+    @instrumented('forcetalk', 'delete_assignment')
     def delete_assignment(self, ass_id):
         Logger.debug(f"delete_assignment with {ass_id}")
         forcetalk_url = f'{self.forcetalk_host}/forcetalk/Assignment/{ass_id}'
         headers = {"Accept": "application/json", "Content-type": "application/json"}
         request_with_retry(NewRequest.put, kwargs=dict(url=forcetalk_url, headers=headers, timeout=30))
+        self.invalidate_fingerprints([ass_id])
 
-    def send_assignment_to_forcetalk(self, assignment):
+    @instrumented('forcetalk', 'send_assignment')
+    def send_assignment_to_forcetalk(self, assignment, force=False):
         Logger.debug(f"send_assignment_to_forcetalk with {assignment}")
-        data = {
+        data = self.build_assignment_payload(assignment)
+        forcetalk_url = f'{self.forcetalk_host}/forcetalk/Assignment?checkEligible=false'
+        return self._post_if_changed(forcetalk_url, data, force)
+
+    def _post_if_changed(self, forcetalk_url, data, force):
+        # returns False when the fingerprint store shows this exact payload was already sent
+        digest = None
+        if self.fingerprint_store is not None:
+            digest = FingerprintStore.fingerprint(data)
+            if not force and self.fingerprint_store.is_unchanged(data['id'], digest):
+                Logger.debug(f"skip unchanged {data['id']}")
+                return False
+        headers = {"Accept": "application/json", "Content-type": "application/json"}
+        request_with_retry(NewRequest.post, kwargs=dict(url=forcetalk_url, headers=headers, data=json.dumps(data), timeout=30))
+        if digest is not None:
+            self.fingerprint_store.put(data['id'], digest)
+        return True
+
+    def invalidate_fingerprints(self, entity_ids=None):
+        if self.fingerprint_store is not None:
+            self.fingerprint_store.invalidate(entity_ids)
+
+    def build_assignment_payload(self, assignment):
+        return {
             "id": assignment['id'],
             "project": {
                 'sf_id': assignment['project']['opportunityId']
@@ -89,12 +130,42 @@ class ForcetalkClient:
             "effort": int(assignment['effort']),
             "shadow": assignment['shadow'] == 'true',
         }
-        forcetalk_url = f'{self.forcetalk_host}/forcetalk/Assignment?checkEligible=false'
-        headers = {"Accept": "application/json", "Content-type": "application/json"}
-        request_with_retry(NewRequest.post, kwargs=dict(url=forcetalk_url, headers=headers, data=json.dumps(data), timeout=30))
 
+    @instrumented('forcetalk', 'flag_project_as_eligible_for_live_feed')
     def flag_project_as_eligible_for_live_feed(self, opportunity_id):
         Logger.debug(f"flagProjectAsEligibleForLiveFeed with {opportunity_id}")
         forcetalk_url = f'{self.forcetalk_host}/forcetalk/Project/flagForLiveFeed/{opportunity_id}'
         headers = {"Accept": "application/json", "Content-type": "application/json"}
         request_with_retry(NewRequest.put, kwargs=dict(url=forcetalk_url, headers=headers, timeout=30))
+
+    def send_staffing_requests(self, staffing_requests, concurrency=10, force=False):
+        return self._run_batch(self.send_staffing_request_to_forcetalk, staffing_requests, concurrency, force=force)
+
+    def send_assignments(self, assignments, concurrency=10, force=False):
+        return self._run_batch(self.send_assignment_to_forcetalk, assignments, concurrency, force=force)
+
+    def delete_resource_requests(self, res_req_ids, concurrency=10):
+        return self._run_batch(self.delete_resource_request, res_req_ids, concurrency)
+
+    def delete_assignments(self, ass_ids, concurrency=10):
+        return self._run_batch(self.delete_assignment, ass_ids, concurrency)
+
+    def _run_batch(self, function, items, concurrency, **kwargs):
+        # payloads are built inside each task so they overlap with other items' HTTP calls;
+        # the shared transport's per-host cap still applies on top of `concurrency`
+        pool = ThreadPool(total_thread_number=concurrency)
+        for item in items:
+            pool.apply_async(self._run_batch_item, (function, item, kwargs))
+        results = pool.get_results_order_by_index()
+        failures = [result for result in results if not result['success']]
+        if failures:
+            Logger.error(f"{function.__name__} failed for {len(failures)}/{len(results)} items")
+        return results
+
+    def _run_batch_item(self, function, item, kwargs):
+        try:
+            result = function(item, **kwargs)
+        except Exception as e:
+            Logger.error(f"{function.__name__} failed with {item}: {e}")
+            return {'item': item, 'success': False, 'result': None, 'errors': [str(e)]}
+        return {'item': item, 'success': True, 'result': result, 'errors': []}
@@ -1,40 +1,174 @@
 from email.mime.text import MIMEText
 from email.header import Header
-from smtplib import SMTP_SSL
+from smtplib import SMTP_SSL, SMTPException, SMTPServerDisconnected
+import html
+import io
+import itertools
+import queue
+import threading
+import time
+
+from python_utils.logger import Logger
+
+from .metrics import instrumented
 
 
 class QQMailClient:
+    """Sends through one logged-in SMTP session that is reopened when the server drops it."""
+
+    host_server = 'smtp.qq.com'
 
-    def __init__(self, sender, pwd, receiver):
+    def __init__(self, sender, pwd, receiver, rate_limiter=None):
 
         self.sender = sender
         self.pwd = pwd
         self.receiver = receiver
+        self.rate_limiter = rate_limiter
+        self._smtp = None
+        self._lock = threading.Lock()
+        self._queue = None
+        self._worker = None
 
+    @instrumented('qq_mail', 'send_mail')
     def send_mail(self, mail_title, mail_content):
-        host_server = 'smtp.qq.com'
-        sender_qq_mail = f'{self.sender}@qq.com'
+        self.send_mails([(mail_title, mail_content)])
 
-        smtp = SMTP_SSL(host_server)
-        smtp.set_debuglevel(0)
-        smtp.ehlo(host_server)
-        smtp.login(self.sender, self.pwd)
+    def send_mails(self, mails):
+        # mails is an iterable of (title, content); all of them go over the same connection
+        with self._lock:
+            for mail_title, mail_content in mails:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire()
+                self._send_message(self._build_message(mail_title, mail_content))
 
+    def _build_message(self, mail_title, mail_content):
         msg = MIMEText(mail_content, "html", 'utf-8')
         msg["Subject"] = Header(mail_title, 'utf-8')
-        msg["From"] = sender_qq_mail
+        msg["From"] = f'{self.sender}@qq.com'
         msg["To"] = self.receiver
-        smtp.sendmail(sender_qq_mail, self.receiver, msg.as_string())
-        smtp.quit()
+        return msg.as_string()
+
+    def _send_message(self, message):
+        reconnected = self._smtp is None
+        if reconnected:
+            self._connect()
+        try:
+            self._smtp.sendmail(f'{self.sender}@qq.com', self.receiver, message)
+        except (SMTPServerDisconnected, ConnectionError):
+            # the server closes idle sessions; a fresh one gets a single retry
+            self._disconnect()
+            if reconnected:
+                raise
+            self._connect()
+            self._smtp.sendmail(f'{self.sender}@qq.com', self.receiver, message)
+
+    def _connect(self):
+        smtp = SMTP_SSL(self.host_server)
+        smtp.set_debuglevel(0)
+        smtp.ehlo(self.host_server)
+        smtp.login(self.sender, self.pwd)
+        self._smtp = smtp
+
+    def _disconnect(self):
+        smtp, self._smtp = self._smtp, None
+        if smtp is None:
+            return
+        try:
+            smtp.quit()
+        except (SMTPException, OSError):
+            smtp.close()
+
+    def start_queue(self, coalesce_interval=1, max_batch=50):
+        # queued mails arriving within coalesce_interval of each other are sent as one batch
+        if self._worker is not None:
+            return
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._drain_queue, args=(self._queue, coalesce_interval, max_batch), daemon=True)
+        self._worker.start()
 
+    def queue_mail(self, mail_title, mail_content):
+        if self._queue is None:
+            raise RuntimeError("Mail queue is not started")
+        self._queue.put((mail_title, mail_content))
 
-def rows_to_table_string(rows):
-    has_cell = False
-    table_string = '<table style="border-collapse:collapse;">\n'
+    def _drain_queue(self, mail_queue, coalesce_interval, max_batch):
+        stopping = False
+        while not stopping:
+            mail = mail_queue.get()
+            if mail is None:
+                return
+            batch = [mail]
+            deadline = time.monotonic() + coalesce_interval
+            while len(batch) < max_batch:
+                try:
+                    mail = mail_queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if mail is None:
+                    stopping = True
+                    break
+                batch.append(mail)
+            try:
+                self.send_mails(batch)
+            except Exception as e:
+                Logger.error(f"op=send_mails | status=ERROR | desc=Failed to send {len(batch)} queued mails: {e}")
+
+    def close(self):
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join()
+            self._queue, self._worker = None, None
+        with self._lock:
+            self._disconnect()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+TABLE_CLASS = 'report-table'
+TABLE_STYLE = (f'<style>table.{TABLE_CLASS} {{border-collapse:collapse;}} '
+               f'table.{TABLE_CLASS} td {{border: 1px solid #000; padding: 10px; background-color: #eee; color: black}}</style>\n')
+
+
+def write_table(rows, out, max_rows=None, escape=True, count_truncated=False, include_style=True):
+    # streams rows into out (anything with write) and returns how many rows with cells were written; nothing is
+    # written without a cell. max_rows caps rows with cells; count_truncated drains the rest of rows to count them
+    rows = iter(rows)
+    written, empty_rows, width = 0, 0, 1
     for row in rows:
-        table_string += '\t<tr>\n'
-        for cell in row:
-            has_cell = True
-            table_string += f'\t\t<td style="border: 1px solid #000; padding: 10px; background-color: #eee; color: black">{cell}</td>\n'
-        table_string += '\t</tr>\n'
-    return table_string + '</table>\n' if has_cell else ''
+        cells = [f'\t\t<td>{html.escape(str(cell)) if escape else cell}</td>\n' for cell in row]
+        if not cells:
+            empty_rows += 1
+            continue
+        if max_rows is not None and written >= max_rows:
+            if written:
+                message = f'{1 + sum(1 for row in rows if any(True for _ in row))} more rows truncated' if count_truncated else 'more rows truncated'
+                out.write(f'\t<tr><td colspan="{width}">{message}</td></tr>\n')
+            empty_rows = 0
+            break
+        if not written:
+            out.write(f'{TABLE_STYLE if include_style else ""}<table class="{TABLE_CLASS}">\n')
+        out.write('\t<tr>\n\t</tr>\n' * empty_rows + f'\t<tr>\n{"".join(cells)}\t</tr>\n')
+        written, empty_rows, width = written + 1, 0, max(width, len(cells))
+    if written:
+        out.write('\t<tr>\n\t</tr>\n' * empty_rows + '</table>\n')
+    return written
+
+
+def iter_table_pages(rows, page_size, escape=True):
+    # one table string per page_size rows, e.g. to split a large report across several mails;
+    # pages carry no <style>, so put TABLE_STYLE once at the top of each mail body
+    rows = iter(rows)
+    for first_row in rows:
+        buffer = io.StringIO()
+        if write_table(itertools.chain([first_row], itertools.islice(rows, page_size - 1)), buffer, escape=escape, include_style=False):
+            yield buffer.getvalue()
+
+
+def rows_to_table_string(rows, max_rows=None, escape=True, count_truncated=False):
+    buffer = io.StringIO()
+    write_table(rows, buffer, max_rows=max_rows, escape=escape, count_truncated=count_truncated)
+    return buffer.getvalue()
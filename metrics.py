@@ -0,0 +1,135 @@
+import bisect
+import functools
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+class Metrics:
+    """Process-wide latency histograms and counters for the clients in this package.
+
+    Disabled by default; while disabled every hook returns after a single
+    attribute check.
+    """
+
+    enabled = False
+    prefix = 'client_utils'
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    _histograms = dict()
+    _counters = dict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def enable(cls):
+        cls.enabled = True
+
+    @classmethod
+    def disable(cls):
+        cls.enabled = False
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._histograms = dict()
+            cls._counters = dict()
+
+    @classmethod
+    def increment(cls, name, value=1, **labels):
+        if not cls.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with cls._lock:
+            cls._counters[key] = cls._counters.get(key, 0) + value
+
+    @classmethod
+    def observe(cls, name, value, **labels):
+        if not cls.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with cls._lock:
+            histogram = cls._histograms.get(key)
+            if histogram is None:
+                histogram = cls._histograms[key] = {'buckets': [0] * (len(cls.buckets) + 1), 'sum': 0.0, 'count': 0}
+            histogram['buckets'][bisect.bisect_left(cls.buckets, value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @classmethod
+    def record_response(cls, res, *args, **kwargs):
+        # requests response hook; uses Content-Length so streamed bodies are not consumed
+        if cls.enabled:
+            host = urlsplit(res.url).netloc
+            body = res.request.body
+            cls.increment('bytes_sent_total', len(body) if body is not None and hasattr(body, '__len__') else 0, host=host)
+            cls.increment('bytes_received_total', int(res.headers.get('Content-Length', 0)), host=host)
+            cls.increment('http_responses_total', host=host, status=str(res.status_code))
+        return res
+
+    @classmethod
+    def snapshot(cls):
+        with cls._lock:
+            return {
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in cls._counters.items()],
+                'histograms': [{'name': name, 'labels': dict(labels), 'buckets': dict(zip([str(bound) for bound in cls.buckets] + ['+Inf'], histogram['buckets'])),
+                                'sum': histogram['sum'], 'count': histogram['count']}
+                               for (name, labels), histogram in cls._histograms.items()],
+            }
+
+    @classmethod
+    def to_json(cls):
+        return json.dumps(cls.snapshot(), indent=2)
+
+    @classmethod
+    def to_prometheus(cls):
+        lines = []
+        with cls._lock:
+            counters = sorted(cls._counters.items())
+            histograms = sorted((key, {**histogram, 'buckets': list(histogram['buckets'])}) for key, histogram in cls._histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {cls.prefix}_{name} counter')
+            lines.append(f'{cls.prefix}_{name}{cls._format_labels(labels)} {value}')
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {cls.prefix}_{name} histogram')
+            cumulative = 0
+            for bound, count in zip([str(bound) for bound in cls.buckets] + ['+Inf'], histogram['buckets']):
+                cumulative += count
+                lines.append(f'{cls.prefix}_{name}_bucket{cls._format_labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{cls.prefix}_{name}_sum{cls._format_labels(labels)} {histogram["sum"]}')
+            lines.append(f'{cls.prefix}_{name}_count{cls._format_labels(labels)} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{name}="{Metrics._escape(value)}"' for name, value in labels) + '}'
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def instrumented(client, operation):
+    def _decorate(function):
+        @functools.wraps(function)
+        def wrapped_function(*args, **kwargs):
+            if not Metrics.enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except BaseException:
+                Metrics.increment('operation_errors_total', client=client, operation=operation)
+                raise
+            finally:
+                Metrics.observe('operation_seconds', time.perf_counter() - start, client=client, operation=operation)
+                Metrics.increment('operations_total', client=client, operation=operation)
+        return wrapped_function
+    return _decorate
@@ -1,58 +1,172 @@
+import json
+import re
+import threading
+import time
+
+from .chunking import chunk_by_length
 from .config import Config
 from python_utils.logger import Logger
-from python_utils.misc import get_variable_from_local
-import requests
+from python_utils.thread_pool import ThreadPool
+from .metrics import instrumented
+from .request_client import NewRequest
+from .retry_policy import RetryPolicy
+
+
+JIGSAW_DURATION_PATTERN = re.compile(r'"duration"\s*:\s*\{[^{}]*\}')
+JIGSAW_DATE_PATTERN = re.compile(r'("(?:startsOn|endsOn)"\s*:\s*)"([^"-]*)-([^"-]*)-([^"-]*)"')
+
+
+class TokenManager:
+    """In-process token cache keyed by scope.
+
+    Tokens are refreshed in the background once they are within
+    ``refresh_margin`` seconds of expiry, and callers that find a token missing
+    or expired share one in-flight fetch instead of each calling Okta.
+    """
+
+    def __init__(self, fetch_token, refresh_margin=300):
+        self.fetch_token = fetch_token
+        self.refresh_margin = refresh_margin
+        self._tokens = dict()
+        self._refreshing = dict()
+        self._lock = threading.Lock()
+
+    def get(self, scope):
+        with self._lock:
+            token, expires_at = self._tokens.get(scope, (None, 0))
+            now = time.monotonic()
+            if now < expires_at:
+                if now >= expires_at - self.refresh_margin and scope not in self._refreshing:
+                    event = self._refreshing[scope] = threading.Event()
+                    threading.Thread(target=self._refresh, args=(scope, event), daemon=True).start()
+                return token
+            event = self._refreshing.get(scope)
+            is_owner = event is None
+            if is_owner:
+                event = self._refreshing[scope] = threading.Event()
+        if is_owner:
+            self._refresh(scope, event)
+        else:
+            event.wait()
+        with self._lock:
+            token, expires_at = self._tokens.get(scope, (None, 0))
+        if time.monotonic() >= expires_at:
+            raise RuntimeError(f"failed to get token for scope {scope}")
+        return token
+
+    def invalidate(self, scope, token=None):
+        with self._lock:
+            current_token, _ = self._tokens.get(scope, (None, 0))
+            if current_token is not None and (token is None or token == current_token):
+                del self._tokens[scope]
+
+    def _refresh(self, scope, event):
+        try:
+            token, expires_in = self.fetch_token(scope)
+            with self._lock:
+                self._tokens[scope] = (token, time.monotonic() + expires_in)
+        except Exception as e:
+            Logger.error(f"failed to refresh token for scope {scope}: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.pop(scope, None)
+            event.set()
 
 
 class PlatformAPIClient:
 
+    max_url_length = 6000
+    retry_policy = RetryPolicy(retries=3, base_delay=1)
+    _token_managers = dict()
+    _token_managers_lock = threading.Lock()
+
     def __init__(self, env='uat'):
         self.platform_host = Config.get_config(env, "platform_host")
         self.okta_host = Config.get_config(env, "okta_host")
         self.token_path = Config.get_config(env, "token_path")
         self.okta_token = Config.get_config(env, "okta_token")
+        with PlatformAPIClient._token_managers_lock:
+            key = (self.okta_host, self.token_path)
+            if key not in PlatformAPIClient._token_managers:
+                PlatformAPIClient._token_managers[key] = TokenManager(self._request_token)
+            self.token_manager = PlatformAPIClient._token_managers[key]
+        self.pool = ThreadPool(total_thread_number=10)
 
     def get_assignment_by_ass_id(self, ass_id_list):
-        return self.get_platform_data("api ApiCommonReadAccess", "jigsaw/assignments", "ids[]=" + "&ids[]=".join(ass_id_list))
+        return self.get_platform_data_by_ids("api ApiCommonReadAccess", "jigsaw/assignments", "ids", ass_id_list, key='id')
 
-    def _format_jigsaw_date(self, date):
-        return "-".join(date.split("-")[::-1])
+    def _parse_jigsaw_assignments(self, text):
+        # flips every duration's startsOn/endsOn in one regex pass over the response body before it is parsed
+        return json.loads(JIGSAW_DURATION_PATTERN.sub(
+            lambda match: JIGSAW_DATE_PATTERN.sub(r'\1"\4-\3-\2"', match.group(0)), text))
 
     def get_staffing_requests_by_opportunity_id(self, opportunity_id):
         return self.get_platform_data("api", f"sales-system-service/opportunities/{opportunity_id}/staffing-requests")['content']
 
     def get_assignments_by_opportunity_id(self, opportunity_id):
-        results = self.get_platform_data("api ApiCommonReadAccess", f"jigsaw/assignments", f"opportunity_ids[]={opportunity_id}")
-        for res in results:
-            res["duration"]["startsOn"] = self._format_jigsaw_date(res["duration"]["startsOn"])
-            res["duration"]["endsOn"] = self._format_jigsaw_date(res["duration"]["endsOn"])
-        return results
+        return self.get_assignments_by_opportunity_ids([opportunity_id])
 
-    def get_platform_data(self, scope, path, params=None):
-        Logger.debug(f"get_platform_data with {path}")
-        for _ in range(3):
+    def get_assignments_by_opportunity_ids(self, opportunity_ids):
+        return self.get_platform_data_by_ids("api ApiCommonReadAccess", "jigsaw/assignments", "opportunity_ids", opportunity_ids,
+                                             parse=self._parse_jigsaw_assignments)
 
-            res = requests.get(f"{self.platform_host}/{path}",
-                         params=params,
-                         headers={'Authorization': f'bearer {self.get_token(scope)}'})
+    def get_platform_data_by_ids(self, scope, path, id_param, ids, key=None, parse=None):
+        # splits ids into `id_param[]=` query strings that keep the url under max_url_length, fetched concurrently;
+        # with `key`, results are ordered by the position of result[key] in ids
+        ids = list(ids)
+        if not ids:
+            return []
+        pool = self.pool.new_shared_pool()
+        max_length = self.max_url_length - len(f"{self.platform_host}/{path}?")
+        for chunk in chunk_by_length(ids, max_length, separator_length=len(id_param) + 4):
+            pool.apply_async(self.get_platform_data, (scope, path, f"{id_param}[]=" + f"&{id_param}[]=".join(chunk), parse))
+        results = [result for results in pool.get_results_order_by_index(raise_exception=True) for result in results]
+        if key is not None:
+            positions = {id: index for index, id in reversed(list(enumerate(ids)))}
+            results.sort(key=lambda result: positions.get(result[key], len(ids)))
+        return results
 
-            if res.status_code != 200:
+    @instrumented('platform', 'get_platform_data')
+    def get_platform_data(self, scope, path, params=None, parse=None):
+        Logger.debug(f"get_platform_data with {path}")
+        url = f"{self.platform_host}/{path}"
+        for token_retried in (False, True):
+            token = self.get_token(scope)
+            res = self.retry_policy.call(self._get, (url, params, token), host=url)
+            if res.status_code == 401 and not token_retried:
+                Logger.error(f"Token rejected for {path}, refreshing token of scope {scope}")
+                self.token_manager.invalidate(scope, token)
+            elif res.status_code != 200:
                 Logger.error(f"Failed to get {path}, res: {res.status_code} | {res.text}")
+                break
             else:
-                return res.json()
+                return res.json() if parse is None else parse(res.text)
 
         raise RuntimeError(f"failed to get_platform_data with {path}")
 
+    def _get(self, url, params, token):
+        with NewRequest.get(url, params=params, headers={'Authorization': f'bearer {token}'}) as request:
+            return request.response
+
     def get_token(self, scope):
-        return get_variable_from_local(f'platform_{scope}_token', function_value=self.refresh_token, args=(scope,), keep_time=3000)
+        return self.token_manager.get(scope)
 
     def refresh_token(self, scope):
-        return requests.post(url=f"{self.okta_host}/oauth2/{self.token_path}/v1/token",
-                                   data={'grant_type': 'client_credentials', 'scope': scope},
-                                   headers={
-                                       'Authorization': f'Basic {self.okta_token}',
-                                       'Content-Type': 'application/x-www-form-urlencoded'}
-                                   ).json()['access_token']
+        return self._request_token(scope)[0]
+
+    @instrumented('platform', 'request_token')
+    def _request_token(self, scope):
+        with NewRequest.post(url=f"{self.okta_host}/oauth2/{self.token_path}/v1/token",
+                             data={'grant_type': 'client_credentials', 'scope': scope},
+                             headers={
+                                 'Authorization': f'Basic {self.okta_token}',
+                                 'Content-Type': 'application/x-www-form-urlencoded'}
+                             ) as request:
+            res = request.response
+        if res.status_code != 200:
+            raise RuntimeError(f"failed to refresh token of scope {scope}: {res.status_code} | {res.text}")
+        token = res.json()
+        return token['access_token'], int(token.get('expires_in', 3600))
 
     def get_opportunity_by_id(self, opportunity_id):
         return self.get_platform_data("api", f"sales-system-service/opportunities/{opportunity_id}")
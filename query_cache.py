@@ -0,0 +1,99 @@
+from collections import OrderedDict
+import hashlib
+import os
+import pickle
+import re
+import threading
+import time
+
+from python_utils.logger import Logger
+
+
+class QueryCache:
+    """TTL/LRU cache of query results; with ``path``, each entry is persisted as its own file in that directory."""
+
+    def __init__(self, ttl=600, max_entries=32, path=None, full_refresh_interval=86400, clock_skew=300):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self.full_refresh_interval = full_refresh_interval
+        self.clock_skew = clock_skew
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._key_locks = dict()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            self._load()
+
+    @staticmethod
+    def normalize(query_string):
+        # collapse whitespace outside of quoted literals so formatting differences share one entry
+        parts = re.split(r"('(?:[^'\\]|\\.)*')", query_string.strip())
+        return ''.join(part if index % 2 else re.sub(r"\s+", " ", part) for index, part in enumerate(parts))
+
+    def key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._delete_entry(self._entries.popitem(last=False)[0])
+        # only the changed entry is written, outside the lock so other keys are not held up by the pickling
+        self._save_entry(key, entry)
+
+    def invalidate(self, query_string=None):
+        with self._lock:
+            keys = list(self._entries) if query_string is None else [self.normalize(query_string)]
+            for key in keys:
+                self._entries.pop(key, None)
+                self._delete_entry(key)
+
+    def is_fresh(self, entry):
+        return time.time() - entry['fetched_at'] < self.ttl
+
+    def needs_full_refresh(self, entry):
+        return time.time() - entry['full_fetched_at'] >= self.full_refresh_interval
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.pickle")
+
+    def _load(self):
+        entries = []
+        for file_name in os.listdir(self.path):
+            if not file_name.endswith('.pickle'):
+                continue
+            try:
+                with open(os.path.join(self.path, file_name), 'rb') as f:
+                    key, entry = pickle.load(f)
+                entries.append((entry['fetched_at'], key, entry))
+            except Exception as e:
+                Logger.error(f'failed to load query cache entry {file_name} from {self.path}: {e}')
+        for _, key, entry in sorted(entries, key=lambda item: item[0])[-self.max_entries:]:
+            self._entries[key] = entry
+
+    def _save_entry(self, key, entry):
+        if self.path is None:
+            return
+        entry_path = self._entry_path(key)
+        tmp_path = f'{entry_path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((key, entry), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, entry_path)
+
+    def _delete_entry(self, key):
+        if self.path is None:
+            return
+        try:
+            os.remove(self._entry_path(key))
+        except FileNotFoundError:
+            pass
@@ -1,4 +1,83 @@
+import threading
+import time
+from urllib.parse import urlsplit
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import Metrics
+
+
+class Transport:
+    """Process-wide HTTP transport shared by every REST client in this package.
+
+    A single ``requests.Session`` keeps one keep-alive connection pool per host,
+    so repeated calls to Forcetalk / Platform / ThoughtData reuse TCP+TLS
+    connections instead of paying a new handshake on every request.
+    """
+
+    pool_connections = 20
+    pool_maxsize = 20
+    max_retries = 0
+    timeout = 30
+    max_concurrency_per_host = 20
+
+    _session = None
+    _host_semaphores = dict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, pool_connections=None, pool_maxsize=None, max_retries=None, timeout=None, max_concurrency_per_host=None):
+        with cls._lock:
+            if pool_connections is not None:
+                cls.pool_connections = pool_connections
+            if pool_maxsize is not None:
+                cls.pool_maxsize = pool_maxsize
+            if max_concurrency_per_host is not None:
+                cls.max_concurrency_per_host = max_concurrency_per_host
+                cls._host_semaphores = dict()
+            if max_retries is not None:
+                cls.max_retries = max_retries
+            if timeout is not None:
+                cls.timeout = timeout
+            cls._close_session()
+
+    @classmethod
+    def get_session(cls):
+        if cls._session is None:
+            with cls._lock:
+                if cls._session is None:
+                    cls._session = cls._new_session()
+        return cls._session
+
+    @classmethod
+    def host_semaphore(cls, url):
+        host = urlsplit(url).netloc
+        semaphore = cls._host_semaphores.get(host)
+        if semaphore is None:
+            with cls._lock:
+                semaphore = cls._host_semaphores.setdefault(host, threading.BoundedSemaphore(cls.max_concurrency_per_host))
+        return semaphore
+
+    @classmethod
+    def close(cls):
+        with cls._lock:
+            cls._close_session()
+
+    @classmethod
+    def _new_session(cls):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=cls.pool_connections, pool_maxsize=cls.pool_maxsize, max_retries=cls.max_retries)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.hooks['response'].append(Metrics.record_response)
+        return session
+
+    @classmethod
+    def _close_session(cls):
+        if cls._session is not None:
+            cls._session.close()
+            cls._session = None
 
 
 class NewRequest:
@@ -9,31 +88,38 @@ class NewRequest:
         self.args = args
         self.kwargs = kwargs
         self.response = None
+        self.semaphore = Transport.host_semaphore(args[0] if args else kwargs['url'])
 
     def __enter__(self):
-        self.response = getattr(self.session, self.method)(*self.args, **self.kwargs)
+        self.kwargs.setdefault('timeout', Transport.timeout)
+        if Metrics.enabled:
+            start = time.perf_counter()
+            self.semaphore.acquire()
+            Metrics.observe('pool_wait_seconds', time.perf_counter() - start, pool='http_host')
+        else:
+            self.semaphore.acquire()
+        try:
+            self.response = self.session.request(self.method, *self.args, **self.kwargs)
+        finally:
+            self.semaphore.release()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.session.close()
-        self.response.close()
+        if self.response is not None:
+            self.response.close()
 
     @classmethod
     def get(cls, *args, **kwargs):
-        session = requests.sessions.Session()
-        return NewRequest(session, 'get', args, kwargs)
+        return NewRequest(Transport.get_session(), 'get', args, kwargs)
 
     @classmethod
     def post(cls, *args, **kwargs):
-        session = requests.sessions.Session()
-        return NewRequest(session, 'get', args, kwargs)
+        return NewRequest(Transport.get_session(), 'post', args, kwargs)
 
     @classmethod
     def put(cls, *args, **kwargs):
-        session = requests.sessions.Session()
-        return NewRequest(session, 'get', args, kwargs)
+        return NewRequest(Transport.get_session(), 'put', args, kwargs)
 
     @classmethod
     def delete(cls, *args, **kwargs):
-        session = requests.sessions.Session()
-        return NewRequest(session, 'get', args, kwargs)
+        return NewRequest(Transport.get_session(), 'delete', args, kwargs)
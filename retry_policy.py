@@ -0,0 +1,157 @@
+from collections import deque
+from email.utils import parsedate_to_datetime
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+from python_utils.logger import Logger
+from .metrics import Metrics
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+    """Opens after ``failure_threshold`` consecutive failures and lets one trial call through every ``reset_timeout`` seconds."""
+
+    _breakers = dict()
+    _breakers_lock = threading.Lock()
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_host(cls, url_or_host):
+        host = urlsplit(url_or_host).netloc or url_or_host
+        with cls._breakers_lock:
+            if host not in cls._breakers:
+                cls._breakers[host] = CircuitBreaker(host)
+            return cls._breakers[host]
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at >= self.reset_timeout and not self._trial_running:
+                self._trial_running = True
+                return
+        Metrics.increment('circuit_open_rejections_total', host=self.name)
+        raise CircuitOpenError(f"circuit for {self.name} is open after {self._failures} consecutive failures")
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    Logger.error(f"circuit for {self.name} opened after {self._failures} consecutive failures")
+                self._opened_at = time.monotonic()
+
+
+class RetryBudget:
+    """Allows at most ``max_retries`` retries per ``period`` seconds across every caller sharing it."""
+
+    def __init__(self, max_retries=100, period=60):
+        self.max_retries = max_retries
+        self.period = period
+        self._retried_at = deque()
+        self._lock = threading.Lock()
+
+    def try_spend(self):
+        with self._lock:
+            now = time.monotonic()
+            while self._retried_at and now - self._retried_at[0] > self.period:
+                self._retried_at.popleft()
+            if len(self._retried_at) >= self.max_retries:
+                return False
+            self._retried_at.append(now)
+            return True
+
+
+def is_retryable_response(res):
+    status_code = getattr(res, 'status_code', None)
+    return status_code is not None and (status_code in (408, 425, 429) or status_code >= 500)
+
+
+def get_retry_after(res):
+    retry_after = getattr(res, 'headers', {}).get('Retry-After')
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, an optional shared retry budget and per-host circuit breakers."""
+
+    def __init__(self, retries=3, base_delay=1, max_delay=30, jitter=True, budget=None,
+                 retry_on_exception=None, retry_on_result=is_retryable_response, trips_breaker=None, sleep=None):
+        # retries counts attempts, the first one included
+        if retries < 1:
+            raise ValueError(f"retries must be at least 1, got {retries}")
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.budget = budget
+        self.retry_on_exception = retry_on_exception if retry_on_exception is not None else (lambda e: isinstance(e, (IOError, TimeoutError)))
+        self.retry_on_result = retry_on_result
+        self.trips_breaker = trips_breaker if trips_breaker is not None else self.retry_on_exception
+        self.sleep = sleep if sleep is not None else time.sleep
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return random.uniform(0, delay) if self.jitter else delay
+
+    def call(self, function, args=(), kwargs=None, host=None):
+        # returns the last result once it is not retryable or retries run out; re-raises the last retryable exception
+        kwargs = kwargs if kwargs is not None else dict()
+        breaker = CircuitBreaker.for_host(host) if host else None
+        for attempt in range(self.retries):
+            if breaker is not None:
+                breaker.before_call()
+            try:
+                res = function(*args, **kwargs)
+            except (KeyboardInterrupt, SystemExit, GeneratorExit):
+                raise
+            except BaseException as e:
+                if breaker is not None:
+                    breaker.record_failure() if self.trips_breaker(e) else breaker.record_success()
+                if not self.retry_on_exception(e) or not self._can_retry(attempt):
+                    raise
+                Logger.error(f"{getattr(function, '__name__', function)} failed on attempt {attempt + 1}/{self.retries}: {e!r}")
+                Metrics.increment('retries_total', host=host or 'none', reason=type(e).__name__)
+                self.sleep(self.delay(attempt))
+                continue
+            retryable = self.retry_on_result is not None and self.retry_on_result(res)
+            if breaker is not None:
+                breaker.record_failure() if retryable else breaker.record_success()
+            if not retryable or not self._can_retry(attempt):
+                return res
+            Metrics.increment('retries_total', host=host or 'none', reason=str(getattr(res, 'status_code', 'result')))
+            self.sleep(self.delay(attempt, get_retry_after(res)))
+        return res
+
+    def _can_retry(self, attempt):
+        return attempt + 1 < self.retries and (self.budget is None or self.budget.try_spend())
@@ -1,6 +1,12 @@
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import copy
+import csv
 import functools
+import io
+import itertools
+import json
+import re
+import time
 import traceback
 
 from gevent import Timeout, sleep
@@ -11,76 +17,206 @@ from simple_salesforce import Salesforce
 
 from python_utils.logger import Logger
 from python_utils.thread_pool import ThreadPool
+from .chunking import chunk_by_length
 from .config import Config
+from .metrics import Metrics, instrumented
+from .query_cache import QueryCache
+from .retry_policy import RetryPolicy
+
+
+def _is_salesforce_retryable(e):
+    if isinstance(e, (TimeoutException, IOError)):
+        return True
+    err_msg = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
+    return 'UNABLE_TO_LOCK_ROW' in err_msg or 'ConcurrentPerOrgLongTxn Limit exceeded' in err_msg
+
+
+def _salesforce_host(args):
+    # one circuit breaker per org, so an outage of one instance does not fail-fast the others
+    sf = getattr(args[0], 'sf', None) if args else None
+    return getattr(sf, 'sf_instance', None) or 'salesforce'
 
 
 def salesforce_timeout_retry(timeout=30, retries=5, retry_interval=3):
+    policy = RetryPolicy(retries=retries, base_delay=retry_interval, retry_on_exception=_is_salesforce_retryable,
+                         retry_on_result=lambda res: res is None,
+                         trips_breaker=lambda e: isinstance(e, (TimeoutException, IOError)), sleep=sleep)
+
     def _decorate(function):
+        def call_with_timeout(*args, **kwargs):
+            with Timeout(timeout):
+                return function(*args, **kwargs)
+
         @functools.wraps(function)
         def wrapped_function(*args, **kwargs):
-            for _ in range(retries):
-                try:
-                    with Timeout(timeout):
-                        res = function(*args, **kwargs)
-                        if res is not None:
-                            return res
-                except TimeoutException:
-                    sleep(retry_interval)
-                except Exception as e:
-                    err_msg = traceback.format_exc()
-                    if 'UNABLE_TO_LOCK_ROW' not in err_msg and 'ConcurrentPerOrgLongTxn Limit exceeded' not in err_msg:
-                        raise e
-            raise RuntimeError(f"Failed after {retries} times")
+            try:
+                res = policy.call(call_with_timeout, args, kwargs, host=_salesforce_host(args))
+            except BaseException as e:
+                if _is_salesforce_retryable(e):
+                    raise RuntimeError(f"Failed after {retries} times") from e
+                raise
+            if res is None:
+                raise RuntimeError(f"Failed after {retries} times")
+            return res
         return wrapped_function
     return _decorate
 
 
+class DMLError(RuntimeError):
+
+    def __init__(self, message, failed_indexes, results):
+        super().__init__(message)
+        self.failed_indexes = failed_indexes
+        self.results = results
+
+
+RES_REQ_QUERY = "select pse__Project__c, Jigsaw_ID__c, pse__Start_Date__c, pse__End_Date__c, pse__Resource_Role__c, Custom_Resource_Role__c, (select Start_Date__c, End_Date__c, Bill_Rate__c, Region__r.Name from Resource_Request_Working_Offices__r) from pse__Resource_Request__c"
+ASS_QUERY = "select pse__Project__c, Id, Jigsaw_Assignment_ID__c, pse__Start_Date__c, pse__End_Date__c, Resource_Request__r.Jigsaw_ID__c, pse__Percent_Allocated__c, Shadow__c, pse__Bill_Rate__c from pse__Assignment__c where pse__Status__c != 'Closed'"
+
+
 class SalesforceClient:
 
-    def __init__(self, env='uat'):
-        max_connections = 10
-        session = requests.Session()
-        adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections, max_retries=3)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-        self.sf = Salesforce(**{**Config.get_config(env, "sf_oauth"), "session": session})
+    collection_size = 200
+    max_query_length = 10000
+    id_query_concurrency = 5
+    lock_retry_policy = RetryPolicy(retries=6, base_delay=3, retry_on_exception=lambda e: False, retry_on_result=bool, sleep=sleep)
+
+    def __init__(self, env='uat', bulk_threshold=10000, query_cache=None):
+        self.sf = Salesforce(**{**self.get_login_kwargs(env), "session": self.new_session()})
         self.pool = ThreadPool(total_thread_number=10)
+        self.bulk_threshold = bulk_threshold
+        self.res_req_index = dict()
+        self.ass_index = dict()
+        self.query_cache = query_cache
 
+    @instrumented('salesforce', 'query')
     @salesforce_timeout_retry()
-    def query_with_timeout(self, query_string):
-        return self.sf.query(query_string, include_deleted=False)
+    def query_with_timeout(self, query_string, include_deleted=False):
+        return self.sf.query(query_string, include_deleted=include_deleted)
 
+    @instrumented('salesforce', 'query_more')
     @salesforce_timeout_retry()
     def query_more_with_timeout(self, next_records_identifier):
         return self.sf.query_more(next_records_identifier, identifier_is_url=True)
 
     def query_all_fast(self, query_string):
-        page_size = 2000
         result = self.query_with_timeout(query_string)
         all_records = result['records']
         if not result["done"]:
             total_size = int(result["totalSize"])
-            page_url = result['nextRecordsUrl'].split("-")[0] + "-%s"
+            page_size = self._next_offset(result)
+            page_url = result['nextRecordsUrl'].rsplit("-", 1)[0] + "-%s"
             pool = self.pool.new_shared_pool()
-            for page_num in range(page_size, total_size, page_size):
-                pool.apply_async(self.query_more_with_timeout, (page_url % page_num,))
-            for result in pool.get_results_order_by_index():
-                all_records.extend(result["records"])
+            for start in range(page_size, total_size, page_size):
+                pool.apply_async(self._query_page_range, (page_url, start, min(start + page_size, total_size)))
+            for records in pool.get_results_order_by_index():
+                all_records.extend(records)
         assert all_records is not None, query_string
         return all_records
 
+    def get_login_kwargs(self, env):
+        return Config.get_config(env, "sf_oauth")
+
+    def new_session(self):
+        max_connections = 10
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections, max_retries=3)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.hooks['response'].append(Metrics.record_response)
+        return session
+
+    def query_all_cached(self, query_string, incremental=False):
+        # incremental queries must select Id; they refresh by merging rows whose SystemModstamp moved, unless their
+        # filter reaches into related records, whose changes do not move the parent's SystemModstamp
+        if self.query_cache is None:
+            return self.query_all_fast(query_string)
+        key = QueryCache.normalize(query_string)
+        with self.query_cache.key_lock(key):
+            entry = self.query_cache.get(key)
+            if entry is None or not self.query_cache.is_fresh(entry):
+                now = time.time()
+                mergeable = incremental and not self._filters_on_related_records(query_string)
+                if entry is not None and mergeable and not self.query_cache.needs_full_refresh(entry):
+                    self._merge_changed_records(query_string, entry['records'], entry['fetched_at'] - self.query_cache.clock_skew)
+                    entry = {**entry, 'fetched_at': now}
+                else:
+                    records = self.query_all_fast(query_string)
+                    if incremental:
+                        records = OrderedDict((record['Id'], record) for record in records)
+                    entry = {'records': records, 'fetched_at': now, 'full_fetched_at': now}
+                self.query_cache.put(key, entry)
+            records = entry['records']
+            return list(records.values()) if incremental else list(records)
+
+    def _merge_changed_records(self, query_string, records_by_id, since):
+        modstamp_filter = f"SystemModstamp > {time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(since))}"
+        keyword = 'and' if self._has_outer_where(query_string) else 'where'
+        changed_records = self.query_all_fast(f"{query_string} {keyword} {modstamp_filter}")
+        # queryAll also returns rows deleted since the last fetch, so they leave the cache too
+        probe = f"select Id, IsDeleted from {self._outer_object(query_string)} where {modstamp_filter}"
+        matching_ids = {record['Id'] for record in changed_records}
+        stale_ids = {record['Id'] for record in self.iter_query(probe, include_deleted=True)
+                     if record['IsDeleted'] or record['Id'] not in matching_ids}
+        for record in changed_records:
+            if record['Id'] not in stale_ids:
+                records_by_id[record['Id']] = record
+        for id in stale_ids:
+            records_by_id.pop(id, None)
+        Logger.debug(f'merged {len(changed_records)} changed and dropped {len(stale_ids)} stale records in cached {query_string}')
+
+    def iter_query(self, query_string, prefetch=5, include_deleted=False):
+        result = self.query_with_timeout(query_string, include_deleted)
+        if result["done"]:
+            yield from result['records']
+            return
+        total_size = int(result["totalSize"])
+        page_size = self._next_offset(result)
+        page_url = result['nextRecordsUrl'].rsplit("-", 1)[0] + "-%s"
+        page_ranges = ((start, min(start + page_size, total_size)) for start in range(page_size, total_size, page_size))
+        pending = self._prefetch_pages(page_url, page_ranges, prefetch)
+        yield from result['records']
+        while pending is not None:
+            results = pending.get_results_order_by_index()
+            pending = self._prefetch_pages(page_url, page_ranges, prefetch)
+            for records in results:
+                yield from records
+
+    def _prefetch_pages(self, page_url, page_ranges, prefetch):
+        pool = None
+        for start, end in itertools.islice(page_ranges, prefetch):
+            if pool is None:
+                pool = self.pool.new_shared_pool()
+            pool.apply_async(self._query_page_range, (page_url, start, end))
+        return pool
+
+    def _query_page_range(self, page_url, start, end):
+        # pages can hold fewer rows than the first one (e.g. with child subqueries); follow nextRecordsUrl up to end
+        records = []
+        result = self.query_more_with_timeout(page_url % start)
+        while True:
+            records.extend(result['records'])
+            if result['done'] or self._next_offset(result) >= end:
+                return records[:end - start]
+            result = self.query_more_with_timeout(result['nextRecordsUrl'])
+
+    @staticmethod
+    def _next_offset(result):
+        return int(result['nextRecordsUrl'].rsplit("-", 1)[1])
+
     def query_all_stable(self, query_string):
         all_records = []
         result = self.query_with_timeout(query_string)
         while True:
             all_records.extend(result['records'])
             if not result['done']:
-                result = self.query_more_with_timeout(result['nextRecordsUrl'], identifier_is_url=True)
+                result = self.query_more_with_timeout(result['nextRecordsUrl'])
             else:
                 break
         result['records'] = all_records
         return result
 
+    @instrumented('salesforce', 'bulk_dml')
     def bulk_DML_records(self, object_api_name, operation, data):
         assert operation in ('insert', 'update', 'delete')
         data = list(data)
@@ -88,7 +224,88 @@ class SalesforceClient:
         for index, result in enumerate(res):
             if not result['success']:
                 Logger.error(f'delete failed {data[index]} | {str(result)}')
+        return res
+
+    def bulk2_DML_records(self, object_api_name, operation, data, external_id_field=None, chunk_size=10000, concurrency=4):
+        # yields one result row per record, each with 'success'; up to `concurrency` jobs stay in flight, and the
+        # next chunk is uploaded as soon as the oldest job completes, while its result CSVs are still being read
+        assert operation in ('insert', 'update', 'upsert', 'delete', 'hardDelete')
+        assert operation != 'upsert' or external_id_field is not None
+        data = iter(data)
+        chunks = iter(lambda: list(itertools.islice(data, chunk_size)), [])
+        in_flight = deque(self._submit_bulk2_job(object_api_name, operation, chunk, external_id_field)
+                          for chunk in itertools.islice(chunks, concurrency))
+        while in_flight:
+            job_id = in_flight.popleft().get_results_order_by_index(raise_exception=True)[0]
+            chunk = next(chunks, None)
+            if chunk is not None:
+                in_flight.append(self._submit_bulk2_job(object_api_name, operation, chunk, external_id_field))
+            yield from self._iter_bulk2_results(job_id, 'successfulResults', True)
+            for result in self._iter_bulk2_results(job_id, 'failedResults', False):
+                Logger.error(f'{object_api_name} {operation} failed {str(result)}')
+                yield result
+
+    def _submit_bulk2_job(self, object_api_name, operation, records, external_id_field):
+        pool = self.pool.new_shared_pool()
+        pool.apply_async(self._run_bulk2_job, (object_api_name, operation, records, external_id_field))
+        return pool
+
+    @instrumented('salesforce', 'bulk2_job')
+    def _run_bulk2_job(self, object_api_name, operation, records, external_id_field):
+        job_spec = {'object': object_api_name, 'operation': operation, 'contentType': 'CSV', 'lineEnding': 'LF'}
+        if external_id_field is not None:
+            job_spec['externalIdFieldName'] = external_id_field
+        job_id = self._bulk2_request('POST', '', data=json.dumps(job_spec)).json()['id']
+        self._bulk2_request('PUT', f'{job_id}/batches', data=self._records_to_csv(records),
+                            headers={'Content-Type': 'text/csv'})
+        self._bulk2_request('PATCH', job_id, data=json.dumps({'state': 'UploadComplete'}))
+        poll_interval = 1
+        while True:
+            job = self._bulk2_request('GET', job_id).json()
+            if job['state'] == 'JobComplete':
+                Logger.debug(f'bulk2 job {job_id} complete: {job["numberRecordsProcessed"]} processed, {job["numberRecordsFailed"]} failed')
+                return job_id
+            elif job['state'] in ('Failed', 'Aborted'):
+                raise RuntimeError(f'bulk2 job {job_id} {job["state"]}: {job.get("errorMessage")}')
+            sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, 30)
+
+    def _iter_bulk2_results(self, job_id, result_type, success):
+        res = self._bulk2_request('GET', f'{job_id}/{result_type}/', stream=True)
+        try:
+            res.raw.decode_content = True
+            for row in csv.DictReader(io.TextIOWrapper(res.raw, encoding='utf-8', newline='')):
+                row['success'] = success
+                yield row
+        finally:
+            res.close()
 
+    def _bulk2_request(self, method, path, headers=None, **kwargs):
+        res = self.sf.session.request(method, f'{self.sf.base_url}jobs/ingest/{path}',
+                                      headers={**self.sf.headers, **(headers or {})}, **kwargs)
+        if res.status_code >= 300:
+            raise RuntimeError(f'bulk2 {method} {path} failed: {res.status_code} | {res.text}')
+        return res
+
+    @staticmethod
+    def _records_to_csv(records):
+        field_names = list(OrderedDict.fromkeys(key for record in records for key in record if key != 'attributes'))
+        content = io.StringIO()
+        writer = csv.writer(content, lineterminator='\n')
+        writer.writerow(field_names)
+        for record in records:
+            writer.writerow([SalesforceClient._to_csv_value(record[field_name]) if field_name in record else '' for field_name in field_names])
+        return content.getvalue().encode('utf-8')
+
+    @staticmethod
+    def _to_csv_value(value):
+        if value is None:
+            return '#N/A'
+        elif isinstance(value, bool):
+            return 'true' if value else 'false'
+        return value
+
+    @instrumented('salesforce', 'dml_record')
     @salesforce_timeout_retry()
     def _dml_record(self, object_api_name, operation, data):
         assert operation in ('insert', 'update', 'delete')
@@ -108,40 +325,165 @@ class SalesforceClient:
             return getattr(self.sf, object_api_name).delete(copied_data['Id'])
 
 
-    def dml_records(self, object_api_name, operation, data):
+    def dml_records(self, object_api_name, operation, data, raise_on_error=True):
+        # list input: every record is attempted, then DMLError lists the failed indexes unless raise_on_error is False
         assert operation in ('insert', 'update', 'delete')
         assert type(data) is dict or type(data) is list or type(data) is OrderedDict
         Logger.debug(f'{object_api_name} {operation}: {data}')
         if type(data) is dict or type(data) is OrderedDict:
             return self._dml_record(object_api_name, operation, data)
+        elif len(data) >= self.bulk_threshold:
+            results = self.bulk_DML_records(object_api_name, operation, data)
         elif len(data) > 0:
             pool = self.pool.new_shared_pool()
-            for record in data:
-                pool.apply_async(self._dml_record, (object_api_name, operation, record))
-            pool.get_results_order_by_index(raise_exception=True)
+            for start in range(0, len(data), self.collection_size):
+                pool.apply_async(self._dml_collection, (object_api_name, operation, data[start:start + self.collection_size]))
+            results = [result for results in pool.get_results_order_by_index(raise_exception=True) for result in results]
+            for index, result in enumerate(results):
+                if not result['success']:
+                    Logger.error(f'{object_api_name} {operation} failed {data[index]} | {str(result)}')
+        else:
+            return []
+        failed_indexes = [index for index, result in enumerate(results) if not result['success']]
+        if failed_indexes and raise_on_error:
+            raise DMLError(f'{object_api_name} {operation} failed for {len(failed_indexes)} of {len(data)} records', failed_indexes, results)
+        return results
+
+    def _dml_collection(self, object_api_name, operation, records):
+        # records rejected with UNABLE_TO_LOCK_ROW were not written, so only they are re-sent on each retry
+        results = [None] * len(records)
+        pending = list(range(len(records)))
+
+        def send_pending():
+            nonlocal pending
+            sent_results = self._dml_collection_request(object_api_name, operation, [records[index] for index in pending])
+            for index, result in zip(pending, sent_results):
+                results[index] = result
+            pending = [index for index in pending if self._is_lock_error(results[index])]
+            return pending
+
+        self.lock_retry_policy.call(send_pending)
+        return results
+
+    @instrumented('salesforce', 'dml_collection')
+    def _dml_collection_request(self, object_api_name, operation, records):
+        # a timed-out insert may already have committed part of the collection, so only update/delete are re-sent
+        if 'insert' == operation:
+            return self._insert_collection_request(object_api_name, records)
+        return self._modify_collection_request(object_api_name, operation, records)
+
+    @salesforce_timeout_retry(retries=1)
+    def _insert_collection_request(self, object_api_name, records):
+        payload = {
+            'allOrNone': False,
+            'records': [{'attributes': {'type': object_api_name}, **record} for record in records]
+        }
+        return self.sf.restful('composite/sobjects', method='POST', data=json.dumps(payload))
+
+    @salesforce_timeout_retry()
+    def _modify_collection_request(self, object_api_name, operation, records):
+        if 'delete' == operation:
+            params = {'ids': ','.join(record['Id'] for record in records), 'allOrNone': 'false'}
+            return self.sf.restful('composite/sobjects', params=params, method='DELETE')
+        payload = {
+            'allOrNone': False,
+            'records': [{'attributes': {'type': object_api_name}, **record} for record in records]
+        }
+        return self.sf.restful('composite/sobjects', method='PATCH', data=json.dumps(payload))
+
+    @staticmethod
+    def _is_lock_error(result):
+        return not result['success'] and any(error.get('statusCode') == 'UNABLE_TO_LOCK_ROW' for error in result['errors'])
 
     def get_all_active_projects(self):
-        return self.query_all_fast("select Id, pse__Opportunity__c, pse__Is_Billable__c from pse__Proj__c where Project_Code_FF__c != null and pse__Is_Active__c = true and pse__Closed_for_Time_Entry__c = false and pse__Closed_for_Expense_Entry__c = false and pse__Opportunity__r.pse__Primary_Project__c != null and (not (pse__Project_Type__c = 'Internal' and pse__Region__r.Name = 'ThoughtWorks' and pse__Allow_Timecards_Without_Assignment__c = true))")
+        return self.query_all_cached("select Id, pse__Opportunity__c, pse__Is_Billable__c from pse__Proj__c where Project_Code_FF__c != null and pse__Is_Active__c = true and pse__Closed_for_Time_Entry__c = false and pse__Closed_for_Expense_Entry__c = false and pse__Opportunity__r.pse__Primary_Project__c != null and (not (pse__Project_Type__c = 'Internal' and pse__Region__r.Name = 'ThoughtWorks' and pse__Allow_Timecards_Without_Assignment__c = true))", incremental=True)
 
     def get_res_req_by_proj_id(self, proj_id):
-        return self.query_all_fast(f"select Jigsaw_ID__c, pse__Start_Date__c, pse__End_Date__c, pse__Resource_Role__c, Custom_Resource_Role__c, (select Start_Date__c, End_Date__c, Bill_Rate__c, Region__r.Name from Resource_Request_Working_Offices__r) from pse__Resource_Request__c where pse__Project__c = '{proj_id}'")
+        if proj_id in self.res_req_index:
+            return self.res_req_index[proj_id]
+        return self.query_all_fast(f"{RES_REQ_QUERY} where pse__Project__c = '{proj_id}'")
 
     def get_ass_by_proj_id(self, proj_id):
-        return self.query_all_fast(f"select Id, Jigsaw_Assignment_ID__c, pse__Start_Date__c, pse__End_Date__c, Resource_Request__r.Jigsaw_ID__c, pse__Percent_Allocated__c, Shadow__c, pse__Bill_Rate__c from pse__Assignment__c where pse__Project__c = '{proj_id}' and pse__Status__c != 'Closed'")
+        if proj_id in self.ass_index:
+            return self.ass_index[proj_id]
+        return self.query_all_fast(f"{ASS_QUERY} and pse__Project__c = '{proj_id}'")
+
+    def prefetch_project_children(self, proj_ids):
+        proj_ids = list(proj_ids)
+        self.res_req_index.update(self.query_by_ids(RES_REQ_QUERY, 'pse__Project__c', proj_ids))
+        self.ass_index.update(self.query_by_ids(ASS_QUERY, 'pse__Project__c', proj_ids))
+
+    def clear_project_index(self):
+        self.res_req_index = dict()
+        self.ass_index = dict()
 
     def get_projects_by_oppo_or_proj_ids(self, oppo_ids=None, proj_ids=None):
         assert oppo_ids is not None or proj_ids is not None
-        pool = self.pool.new_shared_pool()
+        query_string = "select Id, pse__Opportunity__c, pse__Is_Billable__c from pse__Proj__c where Project_Code_FF__c != null and pse__Is_Active__c = true and pse__Closed_for_Time_Entry__c = false and pse__Closed_for_Expense_Entry__c = false and pse__Opportunity__r.pse__Primary_Project__c != null"
         if oppo_ids is not None:
-            for id in oppo_ids:
-                pool.apply_async(self.query_all_fast, (f"select Id, pse__Opportunity__c, pse__Is_Billable__c from pse__Proj__c where Project_Code_FF__c != null and pse__Is_Active__c = true and pse__Closed_for_Time_Entry__c = false and pse__Closed_for_Expense_Entry__c = false and pse__Opportunity__c = '{id}' and pse__Opportunity__r.pse__Primary_Project__c != null",))
+            records_by_id = self.query_by_ids(query_string, 'pse__Opportunity__c', oppo_ids)
         else:
-            for id in proj_ids:
-                pool.apply_async(self.query_all_fast, (f"select Id, pse__Opportunity__c, pse__Is_Billable__c from pse__Proj__c where Project_Code_FF__c != null and pse__Is_Active__c = true and pse__Closed_for_Time_Entry__c = false and pse__Closed_for_Expense_Entry__c = false and Id = '{id}' and pse__Opportunity__r.pse__Primary_Project__c != null",))
-        return [res[0] for res in pool.get_results_order_by_index() if len(res) > 0]
+            records_by_id = self.query_by_ids(query_string, 'Id', proj_ids)
+        return [records[0] for records in records_by_id.values() if len(records) > 0]
+
+    def query_by_ids(self, query_string, id_field, ids):
+        # query_string must end with its select/from/where part; the IN clause is appended to it
+        ids = list(OrderedDict.fromkeys(ids))
+        keyword = 'and' if self._has_outer_where(query_string) else 'where'
+        prefix = f"{query_string} {keyword} {id_field} in ("
+        records_by_id = OrderedDict((id, []) for id in ids)
+        if not ids:
+            return records_by_id
+        # chunks get their own pool: query_all_fast waits on page fetches in self.pool, and nesting both there deadlocks
+        pool = ThreadPool(total_thread_number=self.id_query_concurrency)
+        for chunk in chunk_by_length(ids, self.max_query_length - len(prefix) - 1, separator_length=3):
+            pool.apply_async(self.query_all_fast, (prefix + ','.join(f"'{id}'" for id in chunk) + ')',))
+        for records in pool.get_results_order_by_index():
+            for record in records:
+                records_by_id.setdefault(self.get_field(record, id_field), []).append(record)
+        return records_by_id
+
+    @staticmethod
+    def _strip_subqueries(query_string):
+        previous = None
+        while previous != query_string:
+            previous, query_string = query_string, re.sub(r"\([^()]*\)", "", query_string)
+        return query_string
+
+    @staticmethod
+    def _has_outer_where(query_string):
+        return re.search(r"\bwhere\b", SalesforceClient._strip_subqueries(query_string), re.IGNORECASE) is not None
+
+    @staticmethod
+    def _filters_on_related_records(query_string):
+        # true when the outer where clause uses a relationship path (RecordType.Name) or a semi-join
+        text = re.sub(r"'(?:[^'\\]|\\.)*'", "''", query_string)
+        depth = 0
+        for match in re.finditer(r"[()]|\bwhere\b", text, re.IGNORECASE):
+            if match.group(0) == '(':
+                depth += 1
+            elif match.group(0) == ')':
+                depth -= 1
+            elif depth == 0:
+                return re.search(r"\w\.\w|\bselect\b", text[match.end():], re.IGNORECASE) is not None
+        return False
+
+    @staticmethod
+    def _outer_object(query_string):
+        return re.search(r"\bfrom\s+(\w+)", SalesforceClient._strip_subqueries(query_string), re.IGNORECASE).group(1)
+
+    @staticmethod
+    def get_field(record, field_path):
+        for field_name in field_path.split('.'):
+            if record is None:
+                return None
+            record = record[field_name]
+        return record
 
     def get_all_employee_ids(self):
-        return {employee["Employee_ID__c"] for employee in self.query_all_fast("select Employee_ID__c from Contact where RecordType.Name = 'Resource' and pse__Is_Resource__c = true and pse__Is_Resource_Active__c = true")}
+        query_string = "select Id, Employee_ID__c from Contact where RecordType.Name = 'Resource' and pse__Is_Resource__c = true and pse__Is_Resource_Active__c = true"
+        employees = self.iter_query(query_string) if self.query_cache is None else self.query_all_cached(query_string, incremental=True)
+        return {employee["Employee_ID__c"] for employee in employees}
 
     def get_all_employees(self):
-        return self.query_all_fast("select Id, pse__Start_Date__c, Department__c from Contact where RecordType.Name = 'Resource' and pse__Start_Date__c != null")
+        return self.query_all_cached("select Id, pse__Start_Date__c, Department__c from Contact where RecordType.Name = 'Resource' and pse__Start_Date__c != null", incremental=True)
@@ -0,0 +1,92 @@
+from python_utils.logger import Logger
+from .salesforce_client import SalesforceClient
+
+
+def flatten_record(record, prefix='', query_more=None):
+    # Resource_Request__r.Jigsaw_ID__c becomes Resource_Request__r_Jigsaw_ID__c; subquery results keep their records list
+    flat = dict()
+    for key, value in record.items():
+        if key == 'attributes':
+            continue
+        if isinstance(value, dict) and 'records' in value:
+            flat[f'{prefix}{key}'] = [flatten_record(child, query_more=query_more) for child in _child_records(value, query_more)]
+        elif isinstance(value, dict):
+            flat.update(flatten_record(value, f'{prefix}{key}_', query_more))
+        else:
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def _child_records(result, query_more):
+    # a subquery larger than one inline batch comes back with done=False and its own nextRecordsUrl
+    records = list(result['records'])
+    while not result.get('done', True):
+        if query_more is None:
+            raise RuntimeError(f"op=flatten_record | status=Fail | desc=child records continue at {result.get('nextRecordsUrl')} but no query_more was given")
+        result = query_more(result['nextRecordsUrl'])
+        records.extend(result['records'])
+    return records
+
+
+class RecordFlattener:
+    """Maps Salesforce records onto a BigQuery schema.
+
+    A schema field is filled from ``field_map[name]`` (a dotted Salesforce path)
+    when given, otherwise from the flattened record key of the same name.
+    ``query_more`` fetches the remaining pages of child subquery results.
+    """
+
+    converters = {
+        'INTEGER': int, 'INT64': int,
+        'FLOAT': float, 'FLOAT64': float, 'NUMERIC': float,
+        'BOOLEAN': bool, 'BOOL': bool,
+        'STRING': str,
+    }
+
+    def __init__(self, schema, field_map=None, query_more=None):
+        field_map = field_map or dict()
+        self.query_more = query_more
+        self.fields = []
+        for field in schema:
+            if field.field_type in ('RECORD', 'STRUCT'):
+                convert = RecordFlattener(field.fields, query_more=query_more)
+            else:
+                convert = self.converters.get(field.field_type)
+            self.fields.append((field.name, field_map.get(field.name), convert, field.mode == 'REPEATED'))
+
+    def __call__(self, record):
+        flat = flatten_record(record, query_more=self.query_more)
+        row = dict()
+        for name, path, convert, repeated in self.fields:
+            if path is not None:
+                value = SalesforceClient.get_field(record, path)
+            elif isinstance(convert, RecordFlattener) and not repeated:
+                value = record.get(name)
+            else:
+                value = flat.get(name)
+            if value is None or convert is None:
+                row[name] = value
+            elif repeated:
+                row[name] = [convert(item) for item in value]
+            else:
+                row[name] = convert(value)
+        return row
+
+
+def export_query_to_bigquery(salesforce_client, bigquery_client, query_string, dataset_id, table_id, schema,
+                             overwrite=True, field_map=None, prefetch=5, chunk_size=50000, max_concurrent_jobs=4, compress=False):
+    # pages stream out of iter_query into bounded NDJSON load jobs; when every upload slot is busy the
+    # generator chain stops pulling, so at most prefetch pages and max_concurrent_jobs chunks are held
+    flattener = RecordFlattener(schema, field_map, query_more=salesforce_client.query_more_with_timeout)
+    row_count = 0
+
+    def rows():
+        nonlocal row_count
+        for record in salesforce_client.iter_query(query_string, prefetch=prefetch):
+            row_count += 1
+            yield flattener(record)
+
+    bigquery_client.save_json_to_bigquery(dataset_id, table_id, schema, rows(), overwrite=overwrite, chunk_size=chunk_size,
+                                          compress=compress, max_concurrent_jobs=max_concurrent_jobs)
+    Logger.info(f"op=export_query_to_bigquery | status=OK | desc=Exported {row_count} rows into {dataset_id}:{table_id}")
+    return row_count